@@ -0,0 +1,239 @@
+""" Compares the load of clients polling presence with ISON against clients being told about it with MONITOR
+
+A set of target nicks keeps connecting and disconnecting. Watcher clients follow a random subset of the
+targets, either by sending ISON at a fixed interval or by adding them to their MONITOR list once. The
+traffic between the watchers and the server, the server's CPU time and how long watchers take to notice a
+change are reported for both, and for idle watchers as a baseline. The server is run in a child process.
+
+Usage:
+    python bench/monitor_vs_ison.py [--targets 200] [--watchers 50] [--watch 20] [--churn 20] [--interval 2] [--seconds 15]
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def serve(port):
+    """ Runs a quiet server in the child process """
+
+    import server
+    import utils.logger as logger
+    logger.log_incoming = logger.log_outgoing = logger.log_msg = lambda *args: None
+
+    irc = server.Server("BenchServer", port, "bench")
+    irc.init_socket()
+    irc.run()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as sock:
+        sock.bind(("::1", 0))
+        return sock.getsockname()[1]
+
+
+def cpu_seconds(pid):
+    """ Returns the user and system CPU time a process has used so far, Linux only """
+
+    with open("/proc/" + str(pid) + "/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class Connection:
+    """ A registered client that counts the bytes and lines it exchanges with the server """
+
+    def __init__(self, port, nick):
+        for _ in range(50):
+            try:
+                self.sock = socket.create_connection(("::1", port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b""
+        self.sent = 0
+        self.received = 0
+        self.lines = 0
+        self.send("NICK " + nick + "\r\nUSER " + nick + " 0 * :Bench\r\n")
+        while " 001 " not in self.read_line():
+            pass
+
+    def send(self, text):
+        data = text.encode()
+        self.sent += len(data)
+        self.sock.sendall(data)
+
+    def read_line(self):
+        while b"\r\n" not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            self.received += len(data)
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\r\n", 1)
+        self.lines += 1
+        return line.decode()
+
+    def close(self):
+        self.sock.close()
+
+
+class Targets:
+    """ The nicks being watched, with the times they came online or went offline """
+
+    def __init__(self, port, count):
+        self.port = port
+        self.nicks = ["t" + str(i) for i in range(count)]
+        self.online = {}
+        self.changes = {nick: [] for nick in self.nicks}
+
+    def toggle(self, nick):
+        self.changes[nick].append((time.perf_counter(), nick not in self.online))
+        if nick in self.online:
+            self.online.pop(nick).send("QUIT :bye\r\n")
+        else:
+            self.online[nick] = Connection(self.port, nick)
+
+    def delay(self, nick, online, seen):
+        """ Returns how long after the last matching change a watcher saw the new state, or None for the initial state """
+
+        for changed, state in reversed(self.changes[nick]):
+            if changed <= seen and state == online:
+                return seen - changed
+        return None
+
+    def churn(self, rate, stop):
+        while not stop.is_set():
+            self.toggle(random.choice(self.nicks))
+            time.sleep(1 / rate)
+
+
+class Watcher:
+    """ A client following the presence of some targets, recording how long each change took to reach it """
+
+    def __init__(self, port, nick, targets, watched):
+        self.connection = Connection(port, nick)
+        self.targets = targets
+        self.watched = watched
+        self.known = {}
+        self.delays = []
+
+    def saw(self, nick, online):
+        seen = time.perf_counter()
+        if self.known.get(nick) != online:
+            if nick in self.known:
+                delay = self.targets.delay(nick, online, seen)
+                if delay is not None:
+                    self.delays.append(delay)
+            self.known[nick] = online
+
+    def poll(self, interval, stop):
+        """ Sends ISON every interval seconds and compares the reply with the last one """
+
+        try:
+            while not stop.is_set():
+                started = time.perf_counter()
+                self.connection.send("ISON " + " ".join(self.watched) + "\r\n")
+                line = self.connection.read_line()
+                while " 303 " not in line:
+                    line = self.connection.read_line()
+                online = set(line.split(" :", 1)[1].split())
+                for nick in self.watched:
+                    self.saw(nick, nick in online)
+                stop.wait(interval - (time.perf_counter() - started))
+        except OSError:
+            return
+
+    def monitor(self, stop):
+        """ Adds the targets to the MONITOR list once and follows the notifications """
+
+        try:
+            self.connection.send("MONITOR + " + ",".join(self.watched) + "\r\n")
+            while not stop.is_set():
+                line = self.connection.read_line()
+                numeric = line.split(" ")[1]
+                if numeric in ("730", "731"):
+                    for target in line.split(" :", 1)[1].split(","):
+                        self.saw(target.split("!")[0], numeric == "730")
+        except OSError:
+            return
+
+
+def run(args, mode):
+    """ Runs one mode against a fresh server
+
+    Returns:
+        The watchers and the server's CPU seconds during the measurement
+    """
+
+    port = free_port()
+    process = multiprocessing.Process(target=serve, args=(port,), daemon=True)
+    process.start()
+
+    # The same targets, watch lists and churn for both modes
+    random.seed(1)
+    targets = Targets(port, args.targets)
+    for nick in targets.nicks[::2]:
+        targets.toggle(nick)
+    watchers = [Watcher(port, "w" + str(i), targets, random.sample(targets.nicks, args.watch)) for i in range(args.watchers)]
+
+    try:
+        stop = threading.Event()
+        cpu = cpu_seconds(process.pid)
+        for watcher in watchers:
+            if mode == "ISON":
+                threading.Thread(target=watcher.poll, args=(args.interval, stop), daemon=True).start()
+            elif mode == "MONITOR":
+                threading.Thread(target=watcher.monitor, args=(stop,), daemon=True).start()
+        churner = threading.Thread(target=targets.churn, args=(args.churn, stop), daemon=True)
+        churner.start()
+
+        time.sleep(args.seconds)
+        stop.set()
+        churner.join()
+        time.sleep(0.5)
+        cpu = cpu_seconds(process.pid) - cpu
+        return watchers, cpu
+    finally:
+        process.kill()
+        process.join()
+        for connection in [watcher.connection for watcher in watchers] + list(targets.online.values()):
+            connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ISON polling against MONITOR notifications")
+    parser.add_argument("--targets", type=int, default=200, help="nicks that come and go")
+    parser.add_argument("--watchers", type=int, default=50, help="clients following the targets")
+    parser.add_argument("--watch", type=int, default=20, help="targets each watcher follows")
+    parser.add_argument("--churn", type=float, default=20, help="targets connecting or disconnecting per second")
+    parser.add_argument("--interval", type=float, default=2, help="seconds between ISON polls")
+    parser.add_argument("--seconds", type=float, default=15, help="how long to measure each mode")
+    args = parser.parse_args()
+
+    print("mode      bytes in   bytes out    lines in   server CPU s   changes seen   mean delay ms   max delay ms")
+    # With idle watchers the server's CPU time is only spent on the targets coming and going
+    for mode in ["idle", "ISON", "MONITOR"]:
+        watchers, cpu = run(args, mode)
+        delays = [delay * 1000 for watcher in watchers for delay in watcher.delays]
+        print(mode.ljust(8)
+              + str(sum(watcher.connection.received for watcher in watchers)).rjust(10)
+              + str(sum(watcher.connection.sent for watcher in watchers)).rjust(12)
+              + str(sum(watcher.connection.lines for watcher in watchers)).rjust(12)
+              + str(round(cpu, 2)).rjust(15)
+              + str(len(delays)).rjust(15)
+              + str(round(statistics.mean(delays), 1) if delays else "-").rjust(16)
+              + str(round(max(delays), 1) if delays else "-").rjust(15))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+""" Measures how the server behaves when it is offered twice the load it can serve
+
+First the WHO capacity is measured with clients that wait for each reply before sending the next WHO. Then
+the same clients send WHO at twice that rate without waiting, once with load shedding and once without,
+while two other clients measure PRIVMSG latency. The time from sending each WHO to its 315 or 263 and the
+WHOs still waiting for a reply at the end show how far the server has fallen behind. Each case gets a fresh
+server in a child process, which reports its stage changes back.
+
+The channel is no larger than who_slice_size by default, so each WHO is answered in one go. Replies for
+larger channels are built in slices, which keeps the loop's iterations short without shedding.
+
+Usage:
+    python bench/overload.py [--members 100] [--clients 4] [--seconds 12]
+"""
+
+import argparse
+import collections
+import multiprocessing
+import os
+import selectors
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def serve(port, shedding, events):
+    """ Runs a quiet server in the child process, passing load shedding stage changes to events """
+
+    import server
+    import utils.logger as logger
+    logger.log_incoming = logger.log_outgoing = lambda *args: None
+    logger.log_msg = lambda message: events.put((time.time(), message)) if message.startswith("Load shedding") else None
+
+    irc = server.Server("BenchServer", port, "bench")
+    if not shedding:
+        irc.load.thresholds = (float("inf"),) * 3
+    irc.init_socket()
+    irc.run()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as sock:
+        sock.bind(("::1", 0))
+        return sock.getsockname()[1]
+
+
+def connect(port, nick, extra=""):
+    """ Connects and registers a client, returns its socket once the welcome has arrived """
+
+    for _ in range(50):
+        try:
+            sock = socket.create_connection(("::1", port))
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(("NICK " + nick + "\r\nUSER " + nick + " 0 * :Bench\r\n" + extra).encode())
+    read_until(sock, b" 001 ")
+    return sock
+
+
+def read_until(sock, marker, buffer=b""):
+    """ Reads until marker has been received, returns the data before and after it """
+
+    while marker not in buffer:
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        buffer += data
+    return buffer.split(marker, 1)
+
+
+def drain(sockets, stop):
+    """ Discards everything sent to the channel members, answering PINGs so they stay connected """
+
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        sock.setblocking(0)
+        selector.register(sock, selectors.EVENT_READ)
+    while not stop.is_set():
+        for key, _ in selector.select(0.1):
+            try:
+                data = key.fileobj.recv(65536)
+            except (BlockingIOError, ConnectionError):
+                continue
+            if b"PING" in data:
+                for line in data.split(b"\r\n"):
+                    if line.startswith(b"PING"):
+                        key.fileobj.sendall(b"PONG" + line[4:] + b"\r\n")
+
+
+class Loader:
+    """ A client sending WHO, either one at a time or at a fixed rate, and timing the replies
+
+    Replies arrive in the order the WHOs were sent, so each 315 or 263 answers the oldest WHO still waiting.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.answered = 0
+        self.refused = 0
+        self.dropped = False
+        self.sent = collections.deque() # send times of the WHOs still waiting for a reply
+        self.latencies = [] # milliseconds from sending a WHO to its 315 or 263
+        self.lock = threading.Condition()
+
+    def read(self):
+        buffer = b""
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                now = time.perf_counter()
+                lines = (buffer + data).split(b"\r\n")
+                buffer = lines.pop()
+                with self.lock:
+                    for line in lines:
+                        parts = line.split(b" ", 2)
+                        if len(parts) > 1 and parts[1] in (b"315", b"263"):
+                            self.answered += parts[1] == b"315"
+                            self.refused += parts[1] == b"263"
+                            self.latencies.append((now - self.sent.popleft()) * 1000)
+                    self.lock.notify()
+        except OSError:
+            pass
+        self.dropped = True
+        with self.lock:
+            self.lock.notify()
+
+    def send(self, count):
+        with self.lock:
+            self.sent.extend([time.perf_counter()] * count)
+        self.sock.sendall(b"WHO #room\r\n" * count)
+
+    def closed_loop(self, stop):
+        try:
+            while not stop.is_set() and not self.dropped:
+                with self.lock:
+                    done = self.answered + self.refused
+                self.send(1)
+                with self.lock:
+                    self.lock.wait_for(lambda: self.answered + self.refused > done or self.dropped, 5)
+        except OSError:
+            pass
+
+    def open_loop(self, stop, rate):
+        started = time.perf_counter()
+        sent = 0
+        try:
+            while not stop.is_set() and not self.dropped:
+                due = int((time.perf_counter() - started) * rate)
+                if due > sent:
+                    self.send(due - sent)
+                    sent = due
+                time.sleep(0.005)
+        except OSError:
+            pass
+
+
+def run(port, clients, seconds, rate, tag):
+    """ Runs WHO load against a started server while measuring PRIVMSG latency
+
+    Args:
+        rate: WHO per second for each client, or None to wait for each reply instead
+        tag: A letter that keeps the nicks of this run apart from earlier runs
+
+    Returns:
+        A dictionary with PRIVMSG and WHO latencies in milliseconds, WHO answered and refused per second, the
+        WHOs still waiting for a reply at the end and the number of loaders dropped
+    """
+
+    loaders = [Loader(connect(port, tag + "load" + str(i))) for i in range(clients)]
+    stop = threading.Event()
+    for loader in loaders:
+        threading.Thread(target=loader.read, daemon=True).start()
+        if rate is None:
+            threading.Thread(target=loader.closed_loop, args=(stop,), daemon=True).start()
+        else:
+            threading.Thread(target=loader.open_loop, args=(stop, rate), daemon=True).start()
+
+    sender = connect(port, tag + "sender")
+    receiver = connect(port, tag + "receiver")
+    receiver.settimeout(60)
+    latencies = []
+    buffer = b""
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        sender.sendall(("PRIVMSG " + tag + "receiver :" + repr(time.perf_counter()) + "\r\n").encode())
+        line, buffer = read_until(receiver, b"\r\n", buffer)
+        while b" PRIVMSG " not in line:
+            line, buffer = read_until(receiver, b"\r\n", buffer)
+        latencies.append((time.perf_counter() - float(line.rsplit(b" :", 1)[1])) * 1000)
+        time.sleep(0.02)
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    locks = [loader.lock for loader in loaders]
+    for lock in locks:
+        lock.acquire()
+    result = {
+        "privmsg": latencies,
+        "who": [latency for loader in loaders for latency in loader.latencies],
+        "answered": sum(loader.answered for loader in loaders) / elapsed,
+        "refused": sum(loader.refused for loader in loaders) / elapsed,
+        "waiting": sum(len(loader.sent) for loader in loaders if not loader.dropped),
+        "dropped": sum(loader.dropped for loader in loaders)
+    }
+    for lock in locks:
+        lock.release()
+    for sock in [loader.sock for loader in loaders] + [sender, receiver]:
+        sock.close()
+    return result
+
+
+def start(members, shedding):
+    """ Starts a server with a channel of the given size """
+
+    port = free_port()
+    events = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(port, shedding, events), daemon=True)
+    process.start()
+
+    member_sockets = [connect(port, "m" + str(i), "JOIN #room\r\n") for i in range(members)]
+    stop = threading.Event()
+    threading.Thread(target=drain, args=(member_sockets, stop), daemon=True).start()
+    return port, process, events, member_sockets, stop
+
+
+def percentiles(latencies):
+    """ Returns the median and 99th percentile of a list of latencies as text columns """
+
+    if len(latencies) == 0:
+        return "-".rjust(8) + "-".rjust(8)
+    latencies = sorted(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    return str(round(statistics.median(latencies), 1)).rjust(8) + str(round(p99, 1)).rjust(8)
+
+
+def report(name, result, changes):
+    print(name.ljust(17) + percentiles(result["privmsg"]) + percentiles(result["who"]) + str(round(result["answered"], 1)).rjust(10)
+          + str(round(result["refused"], 1)).rjust(9) + str(result["waiting"]).rjust(9) + str(result["dropped"]).rjust(9) + str(changes).rjust(9))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server behaviour at twice its measured WHO capacity")
+    parser.add_argument("--members", type=int, default=100, help="members of the channel WHO is run on")
+    parser.add_argument("--clients", type=int, default=4, help="clients sending WHO")
+    parser.add_argument("--seconds", type=float, default=12, help="how long to measure each overloaded case")
+    args = parser.parse_args()
+
+    print("".ljust(17) + "PRIVMSG ms".rjust(16) + "WHO ms".rjust(16))
+    print("case".ljust(17) + "p50".rjust(8) + "p99".rjust(8) + "p50".rjust(8) + "p99".rjust(8) + "WHO ok/s".rjust(10) + "263/s".rjust(9) + "waiting".rjust(9) + "dropped".rjust(9) + "stages".rjust(9))
+    capacity = None
+    for name, shedding in [("capacity", False), ("2x, shedding", True), ("2x, no shedding", False)]:
+        port, process, events, member_sockets, stop = start(args.members, shedding)
+        try:
+            started = time.time()
+            if capacity is None:
+                # Clients that wait for each reply show the rate the server can answer WHO at
+                result = run(port, args.clients, 5, None, "c")
+                capacity = result["answered"]
+            else:
+                result = run(port, args.clients, args.seconds, capacity * 2 / args.clients, "o")
+
+            # Give the last stage changes time to arrive
+            time.sleep(0.2)
+            changes = []
+            while not events.empty():
+                at, message = events.get()
+                if " -> " in message:
+                    changes.append(str(round(at - started, 1)).rjust(9) + "s " + message)
+            report(name, result, len(changes))
+            for change in changes:
+                print(change)
+        finally:
+            stop.set()
+            process.kill()
+            process.join()
+            for sock in member_sockets:
+                sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+""" Measures how many clients per second can reconnect and register, over plain TCP and over TLS with and without session resumption
+
+A self-signed certificate is generated with the openssl command line tool and the server is run in a child
+process. Each connection registers, waits for the welcome and disconnects. Resumed connections reuse the
+session of the previous connection.
+
+Usage:
+    python bench/tls_reconnect.py [--seconds 5]
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def serve(port, tls_port, certfile, keyfile):
+    """ Runs a quiet server in the child process """
+
+    import server
+    import utils.logger as logger
+    logger.log_incoming = logger.log_outgoing = logger.log_msg = lambda *args: None
+
+    irc = server.Server("BenchServer", port, "bench")
+    irc.init_socket()
+    irc.init_tls_socket(tls_port, certfile, keyfile)
+    irc.run()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as sock:
+        sock.bind(("::1", 0))
+        return sock.getsockname()[1]
+
+
+def register(sock, nick):
+    """ Registers a client and waits for the welcome """
+
+    sock.sendall(("NICK " + nick + "\r\nUSER " + nick + " 0 * :Bench\r\n").encode())
+    buffer = b""
+    while b" 001 " not in buffer:
+        data = sock.recv(4096)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        buffer += data
+
+
+def reconnect(port, seconds, context, resume):
+    """ Connects, registers and disconnects for the given time
+
+    Returns:
+        Connections per second and the number of connections that resumed a session
+    """
+
+    session = None
+    count = 0
+    resumed = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        sock = socket.create_connection(("::1", port))
+
+        # After a resumed TLS 1.2 handshake the client's Finished and NICK are separate writes, and with Nagle's
+        # algorithm NICK would wait for the server's delayed ACK
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if context is not None:
+            sock = context.wrap_socket(sock, session=session if resume else None)
+        register(sock, "c" + str(count))
+        if context is not None:
+            resumed += sock.session_reused
+            session = sock.session
+        sock.sendall(b"QUIT :bye\r\n")
+        sock.close()
+        count += 1
+    return count / (time.perf_counter() - started), resumed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconnect rate with and without TLS session resumption")
+    parser.add_argument("--seconds", type=float, default=5, help="how long to measure each case")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile = os.path.join(directory, "cert.pem")
+        keyfile = os.path.join(directory, "key.pem")
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-subj", "/CN=localhost", "-days", "1",
+                        "-keyout", keyfile, "-out", certfile], check=True, capture_output=True)
+
+        port = free_port()
+        tls_port = free_port()
+        process = multiprocessing.Process(target=serve, args=(port, tls_port, certfile, keyfile), daemon=True)
+        process.start()
+        time.sleep(0.5)
+
+        try:
+            print("case                 conn/s   resumed")
+            rate, _ = reconnect(port, args.seconds, None, False)
+            print("plain TCP".ljust(18) + str(round(rate, 1)).rjust(9))
+
+            for version in [ssl.TLSVersion.TLSv1_2, ssl.TLSVersion.TLSv1_3]:
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                context.minimum_version = version
+                context.maximum_version = version
+
+                for resume in [False, True]:
+                    rate, resumed = reconnect(tls_port, args.seconds, context, resume)
+                    name = version.name + (" resumed" if resume else " full")
+                    print(name.ljust(18) + str(round(rate, 1)).rjust(9) + str(resumed).rjust(10))
+        finally:
+            process.kill()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
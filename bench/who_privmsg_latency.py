@@ -0,0 +1,161 @@
+""" Measures PRIVMSG latency while other clients keep running WHO on a large channel
+
+The server is run in a child process three times: without WHO traffic, with each WHO reply built in one go,
+and with the replies built in slices between other clients' commands. The channel's members are added to the
+server directly instead of connecting, so the channel can be larger than select() allows connections. Load
+shedding is switched off, so WHO is never refused and the runs only differ in how the replies are built.
+
+Usage:
+    python bench/who_privmsg_latency.py [--members 5000] [--askers 4] [--seconds 5]
+"""
+
+import argparse
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def serve(port, members, who_slice_size):
+    """ Runs a quiet server with a channel of the given size in the child process """
+
+    import server
+    import utils.logger as logger
+    logger.log_incoming = logger.log_outgoing = logger.log_msg = lambda *args: None
+
+    irc = server.Server("BenchServer", port, "bench")
+    irc.who_slice_size = who_slice_size
+    irc.channels["big"] = server.Channel("big")
+    for i in range(members):
+        nick = "m" + str(i)
+        irc.nicks[nick] = types.SimpleNamespace(nickname=nick, username=nick, host="::1", realname="Bench")
+        irc.channels["big"].add_user(nick)
+    irc.load.thresholds = (float("inf"),) * 3
+    irc.init_socket()
+    irc.run()
+
+
+def free_port():
+    with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as sock:
+        sock.bind(("::1", 0))
+        return sock.getsockname()[1]
+
+
+def connect(port, nick, extra=""):
+    """ Connects and registers a client, returns its socket once the welcome has arrived """
+
+    for _ in range(50):
+        try:
+            sock = socket.create_connection(("::1", port))
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    sock.sendall(("NICK " + nick + "\r\nUSER " + nick + " 0 * :Bench\r\n" + extra).encode())
+    read_until(sock, b" 001 ")
+    return sock
+
+
+def read_until(sock, marker, buffer=b""):
+    """ Reads until marker has been received, returns the data before and after it """
+
+    while marker not in buffer:
+        data = sock.recv(65536)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        buffer += data
+    return buffer.split(marker, 1)
+
+
+def ask_who(sock, stop, counts):
+    """ Runs WHO on the large channel back to back """
+
+    # Only the end of the last read is kept, searching the whole reply on every read would slow the asker down
+    tail = b""
+    try:
+        while not stop.is_set():
+            sock.sendall(b"WHO #big\r\n")
+            while b" 315 " not in tail:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                tail = tail[-4:] + data
+            tail = tail.split(b" 315 ", 1)[1]
+            counts.append(1)
+    except OSError:
+        # The server was stopped at the end of the run
+        return
+
+
+def run(members, askers, seconds, who_slice_size):
+    """ Starts a server and returns PRIVMSG latencies in milliseconds and WHO replies per second """
+
+    port = free_port()
+    process = multiprocessing.Process(target=serve, args=(port, members, who_slice_size), daemon=True)
+    process.start()
+
+    sockets = []
+    try:
+        stop = threading.Event()
+        sender = connect(port, "sender")
+        receiver = connect(port, "receiver")
+        sockets.extend([sender, receiver])
+
+        counts = []
+        for i in range(askers):
+            asker = connect(port, "asker" + str(i))
+            sockets.append(asker)
+            threading.Thread(target=ask_who, args=(asker, stop, counts), daemon=True).start()
+        time.sleep(0.5)
+
+        latencies = []
+        started = time.perf_counter()
+        who_start = len(counts)
+        buffer = b""
+        receiver.settimeout(10)
+        while time.perf_counter() - started < seconds:
+            sender.sendall(("PRIVMSG receiver :" + repr(time.perf_counter()) + "\r\n").encode())
+            line, buffer = read_until(receiver, b"\r\n", buffer)
+            while b" PRIVMSG " not in line:
+                line, buffer = read_until(receiver, b"\r\n", buffer)
+            latencies.append((time.perf_counter() - float(line.rsplit(b" :", 1)[1])) * 1000)
+            time.sleep(0.01)
+        who_rate = (len(counts) - who_start) / (time.perf_counter() - started)
+
+        stop.set()
+        return latencies, who_rate
+    finally:
+        process.kill()
+        process.join()
+        for sock in sockets:
+            sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PRIVMSG latency while WHO runs on a large channel")
+    parser.add_argument("--members", type=int, default=5000, help="members of the channel WHO is run on")
+    parser.add_argument("--askers", type=int, default=4, help="clients running WHO back to back")
+    parser.add_argument("--seconds", type=float, default=5, help="how long to measure each case")
+    args = parser.parse_args()
+
+    cases = [
+        ("no WHO", 0, 100),
+        ("WHO in one go", args.askers, 10 ** 9),
+        ("WHO in slices", args.askers, 100),
+    ]
+    print("members " + str(args.members) + ", askers " + str(args.askers))
+    print("case             p50 ms   p99 ms   max ms   WHO/s")
+    for name, askers, slice_size in cases:
+        latencies, who_rate = run(args.members, askers, args.seconds, slice_size)
+        latencies.sort()
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        print(name.ljust(15) + str(round(statistics.median(latencies), 2)).rjust(8) + str(round(p99, 2)).rjust(9) + str(round(latencies[-1], 2)).rjust(9) + str(round(who_rate, 1)).rjust(8))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,18 @@ answer the most common IRC commands. It can handle multiple clients and channels
 """
 
 
+import argparse
 import select
 import socket
+import ssl
 import time
 import utils.logger as logger
+from utils.casemapping import casefold
+from utils.channel_directory import ChannelDirectory, ListQuery
+from utils.monitor import MonitorIndex
+from utils.overload import LoadMonitor
+from utils.replication import ReplicationPrimary, ReplicationStandby
+from utils.workers import WorkerPool
 
 
 class Channel:
@@ -18,12 +26,16 @@ class Channel:
         name: The name of the channel
         users: A set of all the users which are in the channel
         topic: The topic given to each channel
+        created: The time the channel was created
+        topic_time: The time the topic was last set
     """
 
     def __init__(self, name):
         self.name = name
         self.users = set()
         self.topic = ""
+        self.created = time.time()
+        self.topic_time = 0
 
     def add_user(self, user):
         self.users.add(user)
@@ -36,6 +48,7 @@ class Channel:
 
     def set_topic(self, topic):
         self.topic = topic
+        self.topic_time = time.time()
         
 
 class ClientConnection:
@@ -56,6 +69,11 @@ class ClientConnection:
         self.registered = False
         self.host, self.port, _, _ = socket.getpeername()
         self.write_queue = []
+        self.write_buffer = b"" # encoded data the socket did not accept yet
+        self.sendq = 0 # approximate size of queued and buffered output
+        self.pending = [] # reply generators still producing slices, and the commands queued behind them
+        self.read_buffer = b"" # received data that does not make up a full line yet
+        self.listing = None # the ListQuery of a LIST reply that is still being sent
         self.encoding = "utf-8"
         self.alive = time.time()
         self.ping = time.time()
@@ -84,17 +102,64 @@ class ClientConnection:
 
     def queue_command(self, command):
         """ Queues a command to be sent to the client upon the next write cycle """
-        self.write_queue.append(command)
-        
+        if len(self.pending) > 0:
+            # Keep replies in order, later commands wait until the replies still being built have been queued
+            self.pending.append(command)
+        else:
+            self.write_queue.append(command)
+        self.sendq += len(command)
+
+
+    def produce(self):
+        """ Queues the next slice of a reply that is built in slices, along with the commands queued before the next one """
+        while len(self.pending) > 0:
+            if isinstance(self.pending[0], str):
+                self.write_queue.append(self.pending.pop(0))
+                continue
+
+            commands = next(self.pending[0], None)
+            if commands is None:
+                self.pending.pop(0)
+                continue
+            self.write_queue.extend(commands)
+            self.sendq += sum(len(command) for command in commands)
+            return
+
 
     def sendall(self):
-        """ Sends all transmissions in the write queue """
+        """ Sends all transmissions in the write queue, keeping whatever the non-blocking socket does not accept for the next write cycle """
         transfer_string = ""
         while len(self.write_queue)>0:
             transmission = self.write_queue.pop(0)
             transfer_string += transmission
             logger.log_outgoing(self.host, self.port, transmission)
-        self.socket.sendall(transfer_string.encode(self.encoding))
+        self.write_buffer += transfer_string.encode(self.encoding)
+
+        if len(self.write_buffer) == 0:
+            return
+
+        # Non-blocking sockets may only take part of the data, TLS sockets may take none until the peer has been read from
+        try:
+            sent = self.socket.send(self.write_buffer)
+        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            sent = 0
+        self.write_buffer = self.write_buffer[sent:]
+        self.sendq = len(self.write_buffer)
+
+
+    def has_output(self):
+        """ Returns whether there is data waiting to be sent to the client """
+        return len(self.write_queue) > 0 or len(self.write_buffer) > 0
+
+
+    def output_due(self):
+        """ Returns whether the next slice of a reply should be produced, i.e. everything queued before it has been sent """
+        return len(self.pending) > 0 and not self.has_output()
+
+
+    def list_page_due(self):
+        """ Returns whether the next page of a LIST reply should be produced, i.e. everything queued before it has been sent """
+        return self.listing is not None and not self.has_output() and len(self.pending) == 0
 
 
     def handle_incoming(self, data):
@@ -106,8 +171,19 @@ class ClientConnection:
 
         # Update client's aliveness value
         self.alive = time.time()
+
+        # Only handle complete lines, data can arrive split across reads (e.g. at TLS record boundaries)
+        # Lines may also end in a bare LF, as sent by some clients
+        lines = (self.read_buffer + data).split(b"\n")
+        self.read_buffer = lines.pop()
+        lines = [line.removesuffix(b"\r") for line in lines]
+        if len(self.read_buffer) > 4096:
+            logger.log_msg("Removing connection to client with address " + self.host + " on port " + str(self.port) + ": Line too long.")
+            self.remove_connection("Input line too long.")
+            return
+
         try:
-            transmissions = data.decode(self.encoding).split("\r\n")
+            transmissions = [line.decode(self.encoding) for line in lines]
         except UnicodeError:
             # If the incoming data cannot be decoded under UTF-8, the connection will be killed
             logger.log_msg("Refusing connection to client with address " + self.host + " on port " + str(self.port) + ": Invalid encoding.")
@@ -137,6 +213,11 @@ class ClientConnection:
                 if len(deconstructed) > 1:
                     params = deconstructed[1]
 
+            # Refuse commands the server cannot afford while it is overloaded
+            if self.registered and not self.server.load.allows(command):
+                self.run263(command)
+                continue
+
             # Call event handler
             match command:
                 case "JOIN":
@@ -157,6 +238,14 @@ class ClientConnection:
                     self.on_part(params)
                 case "QUIT":
                     self.on_quit(params)
+                case "TOPIC":
+                    self.on_topic(params)
+                case "LIST":
+                    self.on_list(params)
+                case "ISON":
+                    self.on_ison(params)
+                case "MONITOR":
+                    self.on_monitor(params)
                 case _:
                     self.run421(command)
 
@@ -168,18 +257,25 @@ class ClientConnection:
             message: The message sent to server when client leaves.
         """
 
+        # Drop any background work that is still pending for this client
+        self.server.workers.cancel(self)
+
         # Announce leaving to users
         self.announce_quit(message)
+        if self.registered:
+            self.server.replicate({"op": "quit", "nick": self.nickname})
         
         # Remove from channel lists
         for channel in self.channels.values():
-            channel.remove_user(self.nickname)
-            if len(channel.users) == 0:
-                self.server.remove_channel(channel.name)
+            self.server.remove_client_from_channel(self.nickname, channel.name)
         
+        # Tell watchers the client went offline and stop its own watches
+        if self.registered:
+            self.server.notify_offline(self.nickname)
+        self.server.monitor.clear(self)
+
         # Remove from server nick and clients list
-        if self.nickname in self.server.nicks:
-            del self.server.nicks[self.nickname]
+        self.server.remove_nick(self.nickname)
         if self.socket in self.server.clients:
             del self.server.clients[self.socket]
 
@@ -195,10 +291,21 @@ class ClientConnection:
         """ Refuse the connection to the server if nickname or client is already in the server. """
         self.run451()
         self.sendall()
+        self.server.workers.cancel(self)
+
+        # A refused client that was registered leaves the replicated state and its channels like a quit
+        if self.registered:
+            self.server.replicate({"op": "quit", "nick": self.nickname})
+        for channel in self.channels.values():
+            self.server.remove_client_from_channel(self.nickname, channel.name)
+
+        # Tell watchers the client went offline and stop its own watches
+        if self.registered:
+            self.server.notify_offline(self.nickname)
+        self.server.monitor.clear(self)
 
         # If nickaname already exists in server
-        if self.nickname in self.server.nicks:
-            del self.server.nicks[self.nickname]
+        self.server.remove_nick(self.nickname)
 
         # If client already exists in server
         if self.socket in self.server.clients:
@@ -232,16 +339,43 @@ class ClientConnection:
         self.queue_command(cmd)
 
 
+    def run005(self): #RPL_ISUPPORT
+        cmd = self.command_format(self.server.prefix(), "005", self.nickname + " " + " ".join(self.server.isupport) + " :are supported by this server")
+        self.queue_command(cmd)
+
+
     def run251(self): #RPL_LUSERCLIENT
         cmd = self.command_format(self.server.prefix(), "251", self.nickname + " :There are " + str(len(self.server.clients)) + " users and 0 services on 1 servers")
         self.queue_command(cmd)
     
 
+    def run263(self, command): #RPL_TRYAGAIN
+        logger.log_msg("(263) Server is too busy to run " + command + " for client.")
+        cmd = self.command_format(self.server.prefix(), "263", self.nickname + " " + command + " :Please wait a while and try again.")
+        self.queue_command(cmd)
+
+
     def run315(self): #RPL_ENDOFWHO
         cmd = self.command_format(self.server.prefix(), "315", self.nickname + " :End of WHO list")
         self.queue_command(cmd)
 
 
+    def run303(self, nicks): #RPL_ISON
+        cmd = self.command_format(self.server.prefix(), "303", self.nickname + " :" + " ".join(nicks))
+        self.queue_command(cmd)
+
+
+    def run322(self, name, entry): #RPL_LIST
+        users, topic, _, _ = entry
+        cmd = self.command_format(self.server.prefix(), "322", self.nickname + " #" + name + " " + str(users) + " :" + topic)
+        self.queue_command(cmd)
+
+
+    def run323(self): #RPL_LISTEND
+        cmd = self.command_format(self.server.prefix(), "323", self.nickname + " :End of /LIST")
+        self.queue_command(cmd)
+
+
     def run331(self, name): #RPL_NOTOPIC
         cmd = self.command_format(self.server.prefix(), "331", self.nickname + " #" + name + " :No topic is set")
         self.queue_command(cmd)
@@ -254,8 +388,12 @@ class ClientConnection:
 
     def run352(self, nick, channel): #RPL_WHOREPLY
         client = self.server.nicks[nick]
-        cmd = self.command_format(self.server.prefix(), "352", self.nickname + " #" + channel + " " + client.username + " " + client.host + " " +  self.server.hostname + " " + client.nickname + " H :0 " + client.realname)
+        cmd = self.format352(channel, client.username, client.host, client.nickname, client.realname)
         self.queue_command(cmd)
+
+
+    def format352(self, channel, username, host, nickname, realname): #RPL_WHOREPLY
+        return self.command_format(self.server.prefix(), "352", self.nickname + " #" + channel + " " + username + " " + host + " " +  self.server.hostname + " " + nickname + " H :0 " + realname)
     
 
     def run353(self, name): #RPL_NAMREPLY
@@ -358,6 +496,50 @@ class ClientConnection:
         self.queue_command(cmd)
 
 
+    def run730(self, targets): #RPL_MONONLINE
+        for batch in self.batch(targets):
+            cmd = self.command_format(self.server.prefix(), "730", self.nickname + " :" + batch)
+            self.queue_command(cmd)
+
+
+    def run731(self, targets): #RPL_MONOFFLINE
+        for batch in self.batch(targets):
+            cmd = self.command_format(self.server.prefix(), "731", self.nickname + " :" + batch)
+            self.queue_command(cmd)
+
+
+    def run732(self, targets): #RPL_MONLIST
+        for batch in self.batch(targets):
+            cmd = self.command_format(self.server.prefix(), "732", self.nickname + " :" + batch)
+            self.queue_command(cmd)
+
+
+    def run733(self): #RPL_ENDOFMONLIST
+        cmd = self.command_format(self.server.prefix(), "733", self.nickname + " :End of MONITOR list")
+        self.queue_command(cmd)
+
+
+    def run734(self, targets): #ERR_MONLISTFULL
+        logger.log_msg("(734) Client tried to watch more nicks than allowed.")
+        cmd = self.command_format(self.server.prefix(), "734", self.nickname + " " + str(self.server.monitor.limit) + " " + ",".join(targets) + " :Monitor list is full.")
+        self.queue_command(cmd)
+
+
+    def batch(self, targets, length=400):
+        """ Splits a list of targets into comma separated batches that each fit into a single line """
+
+        batches = []
+        current = ""
+        for target in targets:
+            if current != "" and len(current) + len(target) + 1 > length:
+                batches.append(current)
+                current = ""
+            current = target if current == "" else current + "," + target
+        if current != "":
+            batches.append(current)
+        return batches
+
+
     def runJOIN(self, channel): 
         cmd = self.command_format(self.prefix(), "JOIN", "#" + channel)
         # Send join command to all clients in the channel
@@ -365,6 +547,23 @@ class ClientConnection:
             self.server.nicks[client].queue_command(cmd) 
 
 
+    def runNICK(self, old_prefix):
+        cmd = self.command_format(old_prefix, "NICK", ":" + self.nickname)
+        # Send nick change to the client and everyone sharing a channel with it
+        recipients = {self.nickname}
+        for channel in self.channels.values():
+            recipients.update(channel.users)
+        for nick in recipients:
+            self.server.nicks[nick].queue_command(cmd)
+
+
+    def runTOPIC(self, channel):
+        cmd = self.command_format(self.prefix(), "TOPIC", "#" + channel + " :" + self.channels[channel].topic)
+        # Send topic change to all clients in the channel
+        for client in self.channels[channel].users:
+            self.server.nicks[client].queue_command(cmd)
+
+
     def runPING(self):
         # Record ping time and flag ping as not acknowledged
         self.ping = time.time()
@@ -415,8 +614,8 @@ class ClientConnection:
             self.run431()
             return
 
-        # Check nick does not exist already
-        if params.lower() in [x.lower() for x in self.server.nicks]:
+        # Check nick does not exist already, and is not held for a client reconnecting after a failover
+        if casefold(params) in self.server.folded_nicks or self.server.nick_held_for_other(self, params):
             self.run433()
             return
 
@@ -441,8 +640,16 @@ class ClientConnection:
             else:
                 continue
 
+        # Registered clients are changing their nick
+        if self.registered:
+            self.change_nick(params)
+            return
+
+        # Release a nick that was chosen earlier during registration
+        self.server.remove_nick(self.nickname)
+
         self.nickname = params
-        self.server.nicks[self.nickname] = self
+        self.server.add_nick(self)
 
         if self.nickname != "" and self.username != "":
             self.registered = True
@@ -451,6 +658,27 @@ class ClientConnection:
             self.on_registered()
 
 
+    def change_nick(self, nick):
+        """ Renames a registered client and updates its channel memberships """
+
+        old_nick = self.nickname
+        old_prefix = self.prefix()
+
+        self.server.remove_nick(old_nick)
+        self.nickname = nick
+        self.server.add_nick(self)
+        for channel in self.channels.values():
+            channel.remove_user(old_nick)
+            channel.add_user(nick)
+
+        self.server.replicate({"op": "nick", "old": old_nick, "new": nick})
+        self.runNICK(old_prefix)
+
+        # To watchers the old nick went offline and the new one came online
+        self.server.notify_offline(old_nick)
+        self.server.notify_online(self)
+
+
     def on_user(self, params):
         tokens = params.split(" ", 3)
         
@@ -466,6 +694,12 @@ class ClientConnection:
         self.username = tokens[0]
         self.realname = tokens[3][1:]
 
+        # The nick chosen before USER may be held after a failover for a different username
+        if self.nickname != "" and self.server.nick_held_for_other(self, self.nickname):
+            self.run433()
+            self.server.remove_nick(self.nickname)
+            self.nickname = ""
+
         if self.nickname != "" and self.username != "":
             self.registered = True
 
@@ -480,6 +714,7 @@ class ClientConnection:
         self.run002()
         self.run003()
         self.run004()
+        self.run005()
         self.run251()
 
         # If there is no motd, run error commands, otherwise display motd
@@ -490,6 +725,13 @@ class ClientConnection:
         else:
             self.run422()
 
+        self.server.replicate({"op": "register", "nick": self.nickname, "username": self.username, "realname": self.realname, "host": self.host})
+        self.server.notify_online(self)
+
+        # Rejoin channels held for this client before a failover
+        for channel in self.server.reclaim(self):
+            self.on_join("#" + channel)
+
 
     def on_join(self, params):
         if not self.registered:
@@ -528,9 +770,43 @@ class ClientConnection:
             return
         
         channel = params[1:]
-        for i in self.server.channels[channel].users:
-            self.run352(i, channel)
-        self.run315()
+        if channel not in self.server.channels:
+            self.run403(params)
+            return
+
+        users = self.server.channels[channel].users
+
+        # Small channels are answered straight away
+        if len(users) <= self.server.who_slice_size:
+            for i in users:
+                self.run352(i, channel)
+            self.run315()
+            return
+
+        # Large channels are answered a slice at a time between other clients' commands, so building the replies
+        # does not hold up the loop. Replies to later commands are queued behind them.
+        self.pending.append(self.who_slices(channel))
+
+
+    def who_slices(self, channel):
+        """ Yields the WHO replies for a channel in slices of who_slice_size members, the last slice ends the WHO list
+
+        Args:
+            channel: The channel name
+        """
+
+        # The members are copied when the reply is started, members that leave while it is being sent are skipped
+        if channel in self.server.channels:
+            members = list(self.server.channels[channel].users)
+            size = self.server.who_slice_size
+            for start in range(0, len(members), size):
+                replies = []
+                for nick in members[start:start + size]:
+                    client = self.server.nicks.get(nick)
+                    if client is not None:
+                        replies.append(self.format352(channel, client.username, client.host, client.nickname, client.realname))
+                yield replies
+        yield [self.command_format(self.server.prefix(), "315", self.nickname + " :End of WHO list")]
 
 
     def on_ping(self, params):
@@ -607,10 +883,164 @@ class ClientConnection:
                 continue
 
             self.announce_part(channel)
-            self.channels[channel[1:]].remove_user(self.nickname)
+            self.server.remove_client_from_channel(self.nickname, channel[1:])
             del self.channels[channel[1:]]
+            self.server.replicate({"op": "part", "nick": self.nickname, "channel": channel[1:]})
+
+
+    def on_topic(self, params):
+        if not self.registered:
+            return
+
+        # Check enough params are present
+        if params == "":
+            self.run461()
+            return
+
+        target, _, topic = params.partition(" ")
+        if target == "":
+            self.run461()
+            return
+
+        if target[0] == "#":
+            channel = target[1:]
+        else:
+            channel = target
+
+        if channel not in self.server.channels:
+            self.run403(target)
+            return
+
+        if channel not in self.channels:
+            self.run442(target)
+            return
+
+        # Without a new topic, reply with the current one
+        if topic == "":
+            if self.channels[channel].topic != "":
+                self.run332(channel)
+            else:
+                self.run331(channel)
+            return
+
+        if topic[0] == ":":
+            topic = topic[1:]
+        self.server.set_topic(channel, topic)
+        self.runTOPIC(channel)
     
 
+    def on_list(self, params):
+        if not self.registered:
+            return
+
+        query = ListQuery(params)
+        directory = self.server.directory
+
+        # Explicitly named channels are answered straight away
+        if query.names is not None:
+            for name in query.names:
+                if name in directory.entries and query.matches(name, directory.entries[name]):
+                    self.run322(name, directory.entries[name])
+            self.run323()
+            return
+
+        # Everything else is streamed page by page as the client drains its output
+        self.listing = query
+        self.continue_list()
+
+
+    def continue_list(self):
+        """ Sends the next page of a LIST reply, ending the reply once the directory has been scanned """
+
+        query = self.listing
+        directory = self.server.directory
+        keys = directory.scan(query.cursor, query.min_users, query.max_users, self.server.list_page_size)
+
+        for key in keys:
+            name = key[1]
+            if query.matches(name, directory.entries[name]):
+                self.run322(name, directory.entries[name])
+
+        if len(keys) > 0:
+            query.cursor = keys[-1]
+        if len(keys) < self.server.list_page_size:
+            self.run323()
+            self.listing = None
+
+
+    def on_ison(self, params):
+        if not self.registered:
+            return
+
+        # Check enough params are present
+        if params == "":
+            self.run461()
+            return
+
+        online = []
+        for nick in params.replace(":", "").split(" "):
+            client = self.server.folded_nicks.get(casefold(nick))
+            if client is not None and client.registered:
+                online.append(client.nickname)
+        self.run303(online)
+
+
+    def on_monitor(self, params):
+        if not self.registered:
+            return
+
+        # Check enough params are present
+        if params == "":
+            self.run461()
+            return
+
+        action, _, targets = params.partition(" ")
+        targets = [target for target in targets.split(",") if target != ""]
+        monitor = self.server.monitor
+
+        match action:
+            case "+":
+                if len(targets) == 0:
+                    self.run461()
+                    return
+
+                added = []
+                for i in range(len(targets)):
+                    if not monitor.add(self, targets[i]):
+                        self.run734(targets[i:])
+                        break
+                    added.append(targets[i])
+                self.send_monitor_status(added)
+            case "-":
+                for target in targets:
+                    monitor.remove(self, target)
+            case "C":
+                monitor.clear(self)
+            case "L":
+                self.run732(monitor.targets(self))
+                self.run733()
+            case "S":
+                self.send_monitor_status(monitor.targets(self))
+
+
+    def send_monitor_status(self, targets):
+        """ Replies which of the given nicks are online and which are offline """
+
+        online = []
+        offline = []
+        for target in targets:
+            client = self.server.folded_nicks.get(casefold(target))
+            if client is not None and client.registered:
+                online.append(client.prefix()[1:])
+            else:
+                offline.append(target)
+
+        if len(online) > 0:
+            self.run730(online)
+        if len(offline) > 0:
+            self.run731(offline)
+
+
     def send_channel_message(self, target, msg):
         cmd = self.command_format(self.prefix(), "PRIVMSG", target + " :" + msg)
 
@@ -647,54 +1077,206 @@ class Server:
         self.channels = {} # name -> channel
         self.clients = {} # socket -> client
         self.nicks = {} # nick -> client
+        self.folded_nicks = {} # casefolded nick -> client
+        self.monitor = MonitorIndex(100)
         self.socket = None
         self.hostname = ""
         self.version = "LudServer1.0"
+        self.tls_port = None
+        self.tls_socket = None
+        self.tls_context = None
+        self.handshakes = {} # socket -> [wants write, start time] for TLS connections still handshaking
+        self.handshake_timeout = 10
+        self.directory = ChannelDirectory()
+        self.list_page_size = 100 # channels scanned per page of a LIST reply
+        self.isupport = ["CHANTYPES=#", "CASEMAPPING=ascii", "ELIST=CMNTU", "MONITOR=" + str(self.monitor.limit), "SAFELIST"]
+        self.workers = WorkerPool(4, 64, 1)
+        self.load = LoadMonitor()
+        self.last_accept = 0
+        self.last_load_report = 0
+        self.sendq_limit = 1024 * 1024 # clients with more pending output than this are dropped
+        self.who_slice_size = 100 # WHO replies for larger channels are built this many members at a time
+        self.replication = None
+        self.restored_nicks = {} # casefolded nick -> replicated user, held for clients reconnecting after a failover
+        self.restored_topics = {} # name -> topic, applied when a restored channel is recreated
+        self.restore_expiry = 0
+
+
+    def init_tls_socket(self, port, certfile, keyfile):
+        """ Initialises a second listening socket which accepts TLS connections
+
+        Handshakes are non-blocking and driven by the select loop. Session tickets and the server-side
+        session cache are enabled so that reconnecting clients can resume instead of doing a full handshake.
 
-
-    def init_socket(self):
-        """ Initialises the socket for the server """
+        Args:
+            port: The port on which to accept TLS connections
+            certfile: Path to the PEM certificate chain
+            keyfile: Path to the PEM private key
+        """
 
         try:
-            self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.socket.setblocking(0)
-            self.socket.bind(("::", self.port))
-            self.socket.listen(5)
-            self.hostname = self.socket.getsockname()[0]
+            self.tls_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.tls_context.load_cert_chain(certfile, keyfile)
+            self.tls_context.options &= ~ssl.OP_NO_TICKET
+            self.tls_context.num_tickets = 2
+
+            self.tls_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+            self.tls_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.tls_socket.setblocking(0)
+            self.tls_socket.bind(("::", port))
+            self.tls_socket.listen(5)
+            self.tls_port = port
         except:
-            logger.log_msg("Oopsie woopsie, something went wrong. The server couldn't be connected to the socket.")
+            logger.log_msg("Oopsie woopsie, something went wrong. The server couldn't set up TLS on port " + str(port) + ".")
             quit()
 
 
+    def accept_tls(self):
+        """ Accepts a TLS connection and starts its handshake """
+
+        client_sock, _ = self.tls_socket.accept()
+        client_sock.setblocking(0)
+
+        # TLS writes each record separately, e.g. the session tickets after a TLS 1.3 handshake, and Nagle's algorithm
+        # would hold back every record after the first until the client's delayed ACK arrives
+        client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tls_sock = self.tls_context.wrap_socket(client_sock, server_side=True, do_handshake_on_connect=False)
+        self.handshakes[tls_sock] = [False, time.time()]
+        self.continue_handshake(tls_sock)
+
+
+    def continue_handshake(self, sock):
+        """ Advances a TLS handshake as far as the available data allows, setting up the ClientConnection once it completes """
+
+        try:
+            sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.handshakes[sock][0] = False
+            return
+        except ssl.SSLWantWriteError:
+            self.handshakes[sock][0] = True
+            return
+        except (ssl.SSLError, OSError) as e:
+            logger.log_msg("TLS handshake failed: " + str(e))
+            del self.handshakes[sock]
+            sock.close()
+            return
+
+        del self.handshakes[sock]
+        new_client = ClientConnection(sock, self)
+        self.clients[sock] = new_client
+
+        if sock.session_reused:
+            logger.log_msg("Accepted new TLS connection from " + new_client.host + " at port " + str(new_client.port) + " (session resumed).")
+        else:
+            logger.log_msg("Accepted new TLS connection from " + new_client.host + " at port " + str(new_client.port) + ".")
+
+
+    def init_socket(self, attempts=1):
+        """ Initialises the socket for the server
+
+        Args:
+            attempts: How many times to try binding the port, one second apart
+        """
+
+        for attempt in range(attempts):
+            try:
+                self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.socket.setblocking(0)
+                self.socket.bind(("::", self.port))
+                self.socket.listen(5)
+                self.hostname = self.socket.getsockname()[0]
+                return
+            except:
+                self.socket.close()
+                if attempt < attempts - 1:
+                    time.sleep(1)
+
+        logger.log_msg("Oopsie woopsie, something went wrong. The server couldn't be connected to the socket.")
+        quit()
+
+
     def run(self):
         """ Runs the server's select loop to check for activity """
 
         logger.log_msg("Listening on port " + str(self.port) + ".")
+        if self.tls_socket is not None:
+            logger.log_msg("Listening for TLS on port " + str(self.tls_port) + ".")
+
         while True:
+            # Only listen for new connections as often as the current load allows
+            accepting = time.time() - self.last_accept >= self.load.accept_interval()
+
             # Sort clients into readable and writable
             r_list = [client.socket for client in self.clients.values()]
-            r_list.append(self.socket)
-            w_list = [client.socket for client in self.clients.values() if len(client.write_queue) > 0]
+            if accepting:
+                r_list.append(self.socket)
+            r_list.append(self.workers.wake_socket)
+            w_list = [client.socket for client in self.clients.values() if client.has_output()]
+            if self.tls_socket is not None:
+                if accepting:
+                    r_list.append(self.tls_socket)
+                r_list.extend(sock for sock, (wants_write, _) in self.handshakes.items() if not wants_write)
+                w_list.extend(sock for sock, (wants_write, _) in self.handshakes.items() if wants_write)
+            if self.replication is not None:
+                r_list.extend(self.replication.read_sockets())
+                w_list.extend(self.replication.write_sockets())
+
+            # Don't wait for activity while a reply has its next slice or page due, clients with unsent output are woken by w_list
+            timeout = 20
+            if any(client.output_due() for client in self.clients.values()):
+                timeout = 0
+            elif self.load.stage > 0:
+                # Wake up regularly while shedding load, so the loop notices recovery and resumes accepting
+                timeout = 1 if accepting else self.load.accept_interval()
+            elif any(client.list_page_due() for client in self.clients.values()):
+                timeout = 0
+
             readable, writable, _ = select.select(
                 r_list, 
                 w_list, 
                 [],
-                20
+                timeout
             )
+            self.load.start()
 
             for sock in readable:
+                self.load.served()
                 if sock == self.socket:
                     # Accept new connection and set up ClientConnection object
                     client_sock, _ = sock.accept()
+                    client_sock.setblocking(0)
+
+                    # Large replies are sent a slice at a time, and Nagle's algorithm would hold back every slice after
+                    # the first until the client's delayed ACK arrives
+                    client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                     new_client = ClientConnection(client_sock, self)
                     self.clients[client_sock] = new_client
+                    self.last_accept = time.time()
                     logger.log_msg("Accepted new connection from " + new_client.host + " at port " + str(new_client.port) + ".")
+                elif sock == self.tls_socket:
+                    # Accept new TLS connection and start its handshake
+                    self.accept_tls()
+                    self.last_accept = time.time()
+                elif sock in self.handshakes:
+                    self.continue_handshake(sock)
+                elif sock == self.workers.wake_socket:
+                    # Deliver results of finished background jobs
+                    self.workers.process_results()
+                elif self.replication is not None and self.replication.owns(sock):
+                    # Accept standbys or notice them leaving
+                    self.replication.handle_readable(sock)
                 else:
                     # Receive data from existing connection
                     try:
                         data = sock.recv(1024)
 
+                        # TLS connections may hold decrypted data that select cannot see
+                        if isinstance(sock, ssl.SSLSocket):
+                            while sock.pending() > 0:
+                                data += sock.recv(sock.pending())
+
                         if data:
                             # Handle incoming data
                             self.clients[sock].handle_incoming(data)
@@ -703,27 +1285,76 @@ class Server:
                             # No incoming data -> client dead
                             logger.log_msg("Connection to " + self.clients[sock].host + " at port " + str(self.clients[sock].port) + " has been removed.")
                             self.clients[sock].remove_connection("Client connection closed.")
-                    except ConnectionResetError:
+                    except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                        # Nothing to read after all, or only part of a TLS record has arrived so far
+                        pass
+                    except (ConnectionResetError, ssl.SSLError):
                         # Client socket shutdown -> client dead
                         logger.log_msg("Connection to " + self.clients[sock].host + " at port " + str(self.clients[sock].port) + " has been removed.")
                         self.clients[sock].remove_connection("Client connection closed.")
             
             for sock in writable:
+                self.load.served()
                 # Tell writable clients to send all transmissions
                 if sock in self.clients:
                     self.clients[sock].sendall()
+                elif sock in self.handshakes:
+                    self.continue_handshake(sock)
+                elif self.replication is not None:
+                    self.replication.handle_writable(sock)
+
+            # Build the next slice of replies for clients that have sent everything queued before it
+            for client in list(self.clients.values()):
+                if client.output_due():
+                    client.produce()
+
+            # Produce the next page of LIST replies for clients that have sent the previous one, unless the server is shedding load
+            if self.load.stage == 0:
+                for client in list(self.clients.values()):
+                    if client.list_page_due():
+                        client.continue_list()
+
+            # Drop clients that are not reading their output, the limit is tightened while the server is overloaded
+            sendq_limit = self.sendq_limit * self.load.sendq_factor()
+            for client in [client for client in self.clients.values() if client.sendq > sendq_limit]:
+                logger.log_msg("Connection to " + client.host + " at port " + str(client.port) + " has been removed: SendQ exceeded.")
+                client.remove_connection("SendQ exceeded.")
 
             # Check which clients are due for an aliveness check (i.e. ping) and which clients have not acknowledged a recent ping
+            # PONGs are allowed to take longer while the server is overloaded, so a slow loop does not cause a cascade of timeouts
             now = time.time()
+            ping_timeout = 15 * (1 + self.load.stage)
             alive_check = [client for client in self.clients.values() if (now - client.alive) > 180 and client.ping_ack == True]
-            dead_connection = [client for client in self.clients.values() if (now - client.ping) > 15 and client.ping_ack == False]
+            dead_connection = [client for client in self.clients.values() if (now - client.ping) > ping_timeout and client.ping_ack == False]
 
             for client in alive_check:
                 client.runPING()
 
+            # Drop TLS connections that never finish their handshake
+            for sock in [sock for sock, (_, started) in self.handshakes.items() if (now - started) > self.handshake_timeout]:
+                logger.log_msg("TLS handshake timed out.")
+                del self.handshakes[sock]
+                sock.close()
+
             for client in dead_connection:
                 logger.log_msg("Connection to " + client.host + " at port " + str(client.port) + " has been removed due to inactivity.")
-                client.remove_connection()
+                client.remove_connection("Ping timeout.")
+
+            # Stop holding state for clients that did not come back after a failover
+            if len(self.restored_nicks) > 0 and now > self.restore_expiry:
+                logger.log_msg("Releasing " + str(len(self.restored_nicks)) + " nicks that were not reclaimed after failover.")
+                for user in self.restored_nicks.values():
+                    self.replicate({"op": "quit", "nick": user["nick"]})
+                self.restored_nicks = {}
+                self.restored_topics = {}
+
+            self.load.finish()
+
+            # Report the load regularly while shedding
+            if self.load.stage > 0 and now - self.last_load_report > 60:
+                logger.log_msg("Load shedding " + LoadMonitor.STAGE_NAMES[self.load.stage] + ": " + self.load.status())
+                self.last_load_report = now
+                self.load.refused = 0
 
 
     def prefix(self):
@@ -731,6 +1362,35 @@ class Server:
         return ":" + self.name
 
 
+    def add_nick(self, client):
+        """ Registers a client under its current nickname """
+
+        self.nicks[client.nickname] = client
+        self.folded_nicks[casefold(client.nickname)] = client
+
+
+    def remove_nick(self, nick):
+        """ Releases a nickname, if it is in use """
+
+        if nick in self.nicks:
+            del self.nicks[nick]
+            del self.folded_nicks[casefold(nick)]
+
+
+    def notify_online(self, client):
+        """ Tells every client watching a nick via MONITOR that it came online """
+
+        for watcher in self.monitor.watchers_of(client.nickname):
+            watcher.run730([client.prefix()[1:]])
+
+
+    def notify_offline(self, nick):
+        """ Tells every client watching a nick via MONITOR that it went offline """
+
+        for watcher in self.monitor.watchers_of(nick):
+            watcher.run731([nick])
+
+
     def add_client_to_channel(self, client_name, channel_name):
         """ Adds a new client into the channel list 
         Args:
@@ -745,22 +1405,156 @@ class Server:
             self.channels[channel_name] = Channel(channel_name)
             self.channels[channel_name].add_user(client_name)
 
+        self.directory.update(self.channels[channel_name])
+        self.replicate({"op": "join", "nick": client_name, "channel": channel_name})
+
+        # Bring back the topic of a channel that existed before a failover
+        if channel_name in self.restored_topics:
+            self.set_topic(channel_name, self.restored_topics.pop(channel_name))
+
+
+    def remove_client_from_channel(self, client_name, channel_name):
+        """ Removes a client from a channel, removing the channel once it is empty
+        Args:
+            client_name: The client's nickname
+            channel_name: The channel's name
+        """
+
+        channel = self.channels[channel_name]
+        channel.remove_user(client_name)
+        if len(channel.users) == 0:
+            self.remove_channel(channel_name)
+        else:
+            self.directory.update(channel)
+
 
     def remove_channel(self, channel):
         del self.channels[channel]
+        self.directory.remove(channel)
         return
 
 
+    def set_topic(self, channel_name, topic):
+        """ Sets the topic of a channel
+        Args:
+            channel_name: The channel's name
+            topic: The new topic
+        """
+
+        self.channels[channel_name].set_topic(topic)
+        self.directory.update(self.channels[channel_name])
+        self.replicate({"op": "topic", "channel": channel_name, "topic": topic})
+
+
+    def start_replication(self, path, state=None):
+        """ Starts streaming state mutations to standbys on a local socket
+        Args:
+            path: The filesystem path of the UNIX domain socket
+            state: The ReplicationState restored after a failover, so standbys also receive the held state
+        """
+
+        self.replication = ReplicationPrimary(path, state=state)
+        self.replication.init_socket()
+
+
+    def replicate(self, entry):
+        """ Records a state mutation with the replication subsystem, if replication is enabled """
+
+        if self.replication is not None:
+            self.replication.record(entry)
+
+
+    def restore(self, state, grace=300):
+        """ Takes over the state replicated from a failed primary
+
+        Nicks and channels are held for the given grace period. A held nick can only be taken by a client
+        with the same host and username, which is then rejoined to its channels. Channels get their topics
+        back when recreated.
+
+        Args:
+            state: The ReplicationState received by the standby
+            grace: Seconds to hold the restored state for reconnecting clients
+        """
+
+        self.restored_nicks = {casefold(nick): dict(user, nick=nick) for nick, user in state.nicks.items()}
+        self.restored_topics = {name: channel["topic"] for name, channel in state.channels.items() if channel["topic"] != ""}
+        self.restore_expiry = time.time() + grace
+        logger.log_msg("Restored " + str(len(self.restored_nicks)) + " nicks and " + str(len(state.channels)) + " channels from the primary.")
+
+
+    def reclaim(self, client):
+        """ Returns the channels held for a client reconnecting after a failover, releasing its held nick """
+
+        user = self.restored_nicks.get(casefold(client.nickname))
+        if user is None or user["username"] != client.username or user["host"] != client.host:
+            return []
+
+        del self.restored_nicks[casefold(client.nickname)]
+
+        # Registering under the held nick replaced its replicated entry, registering in a different case did not
+        if user["nick"] != client.nickname:
+            self.replicate({"op": "quit", "nick": user["nick"]})
+        return sorted(user["channels"])
+
+
+    def nick_held_for_other(self, client, nick):
+        """ Returns whether a nick is held after a failover for someone other than the client
+
+        The username is only compared once the client has sent USER, registration checks the nick again then.
+        """
+
+        user = self.restored_nicks.get(casefold(nick))
+        if user is None:
+            return False
+        return user["host"] != client.host or (client.username != "" and user["username"] != client.username)
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A simple IRC server")
+    parser.add_argument("--port", type=int, default=6667, help="the port to listen on for clients")
+    parser.add_argument("--tls-port", type=int, help="the port to listen on for TLS clients, e.g. 6697")
+    parser.add_argument("--tls-cert", help="the PEM certificate chain for TLS")
+    parser.add_argument("--tls-key", help="the PEM private key for TLS")
+    parser.add_argument("--replication-socket", help="the UNIX domain socket used to replicate state to a standby")
+    parser.add_argument("--standby", action="store_true", help="follow the primary on --replication-socket and take over when it stops")
+    args = parser.parse_args()
+
+    if args.standby and args.replication_socket is None:
+        parser.error("--standby requires --replication-socket")
+    if args.tls_port is not None and (args.tls_cert is None or args.tls_key is None):
+        parser.error("--tls-port requires --tls-cert and --tls-key")
+
     try:
-        server = Server("LudServer", 6667, "This is a cool message")
-        server.init_socket()
+        server = Server("LudServer", args.port, "This is a cool message")
+
+        state = None
+        if args.standby:
+            # Blocks until the primary goes away
+            state = ReplicationStandby(args.replication_socket).follow()
+            server.restore(state)
+            logger.log_msg("Taking over from the primary.")
+
+            # The port may be held for a moment while the failed primary is torn down
+            server.init_socket(attempts=10)
+        else:
+            server.init_socket()
+
+        if args.tls_port is not None:
+            server.init_tls_socket(args.tls_port, args.tls_cert, args.tls_key)
+        if args.replication_socket is not None:
+            server.start_replication(args.replication_socket, state)
         server.run()
 
     except KeyboardInterrupt:
         logger.log_msg("Server shut down.")
-        server.socket.shutdown(socket.SHUT_RDWR)
-        server.socket.close()
+        server.workers.shutdown()
+        if server.replication is not None:
+            server.replication.shutdown()
+        if server.socket is not None:
+            server.socket.shutdown(socket.SHUT_RDWR)
+            server.socket.close()
+        if server.tls_socket is not None:
+            server.tls_socket.close()
         
     except:
         logger.log_msg("An unexpected error has caused the server to shut down.")
\ No newline at end of file
@@ -0,0 +1,99 @@
+import time
+
+from utils.channel_directory import ChannelDirectory, ListQuery
+
+
+class FakeChannel:
+    def __init__(self, name, users, topic="", created=0, topic_time=0):
+        self.name = name
+        self.users = ["u" + str(i) for i in range(users)]
+        self.topic = topic
+        self.created = created
+        self.topic_time = topic_time
+
+
+def build_directory(sizes):
+    directory = ChannelDirectory()
+    for name, users in sizes.items():
+        directory.update(FakeChannel(name, users))
+    return directory
+
+
+def names(keys):
+    return [name for _, name in keys]
+
+
+def test_update_keeps_channels_ordered_by_size():
+    directory = build_directory({"a": 1, "b": 5, "c": 3})
+    assert names(directory.keys) == ["b", "c", "a"]
+
+    directory.update(FakeChannel("a", 10, "new topic"))
+    assert names(directory.keys) == ["a", "b", "c"]
+    assert directory.entries["a"][:2] == (10, "new topic")
+    assert len(directory.keys) == 3
+
+
+def test_remove_drops_key_and_entry():
+    directory = build_directory({"a": 1, "b": 5})
+    directory.remove("b")
+    directory.remove("missing")
+    assert names(directory.keys) == ["a"]
+    assert "b" not in directory.entries
+
+
+def test_scan_respects_member_range():
+    directory = build_directory({"a": 1, "b": 2, "c": 3, "d": 4, "e": 5})
+    assert names(directory.scan(None, 0, None, 10)) == ["e", "d", "c", "b", "a"]
+    assert names(directory.scan(None, 2, 4, 10)) == ["d", "c", "b"]
+    assert names(directory.scan(None, 6, None, 10)) == []
+
+
+def test_scan_pages_from_cursor_across_changes():
+    directory = build_directory({"a": 1, "b": 2, "c": 3, "d": 4})
+    page = directory.scan(None, 0, None, 2)
+    assert names(page) == ["d", "c"]
+
+    # Channels changing between pages don't make the cursor skip the rest
+    directory.remove("c")
+    directory.update(FakeChannel("z", 1))
+    page = directory.scan(page[-1], 0, None, 2)
+    assert names(page) == ["b", "a"]
+    page = directory.scan(page[-1], 0, None, 2)
+    assert names(page) == ["z"]
+
+
+def test_query_parses_member_counts_and_masks():
+    query = ListQuery(">2,<10,#py*,!#python-offtopic,T:*release*")
+    assert query.min_users == 3
+    assert query.max_users == 9
+    assert query.masks == ["#py*"]
+    assert query.negated_masks == ["#python-offtopic"]
+    assert query.topic_masks == ["*release*"]
+    assert query.names is None
+
+
+def test_query_parses_explicit_names_and_ignores_malformed_conditions():
+    query = ListQuery("#a,b,>x,,C<y")
+    assert query.names == ["a", "b"]
+    assert query.min_users == 0
+    assert query.created_after is None
+
+
+def test_query_matches_filters():
+    now = time.time()
+    query = ListQuery(">1,#py*,!#pyspam,T:*Release*,C<60")
+    assert query.matches("python", (3, "New release out", now - 60, 0))
+    assert query.matches("PyPy", (3, "release", now - 60, 0))
+    assert not query.matches("python", (1, "New release out", now - 60, 0))
+    assert not query.matches("pyspam", (3, "release", now - 60, 0))
+    assert not query.matches("rust", (3, "release", now - 60, 0))
+    assert not query.matches("python", (3, "no news", now - 60, 0))
+    assert not query.matches("python", (3, "release", now - 7200, 0))
+
+
+def test_query_topic_time_range():
+    now = time.time()
+    query = ListQuery("T<10,T>1")
+    assert query.matches("a", (1, "", 0, now - 300))
+    assert not query.matches("a", (1, "", 0, now - 3600))
+    assert not query.matches("a", (1, "", 0, now))
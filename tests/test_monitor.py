@@ -0,0 +1,51 @@
+from utils.casemapping import casefold
+from utils.monitor import MonitorIndex
+
+
+def test_casefold_is_ascii_only():
+    assert casefold("Alice[]\\~") == "alice[]\\~"
+    assert casefold("ÄLICE") == "Älice"
+    assert casefold("straße") == "straße"
+
+
+def test_add_is_case_insensitive_and_keeps_given_spelling():
+    index = MonitorIndex(10)
+    assert index.add("c1", "Alice")
+    assert index.add("c1", "ALICE")
+    assert index.targets("c1") == ["Alice"]
+    assert index.watchers_of("alice") == {"c1"}
+
+
+def test_limit_is_enforced_per_client():
+    index = MonitorIndex(2)
+    assert index.add("c1", "a")
+    assert index.add("c1", "b")
+    assert not index.add("c1", "c")
+    assert index.add("c1", "B")
+    assert index.add("c2", "c")
+    assert index.watchers_of("c") == {"c2"}
+
+
+def test_remove_cleans_up_reverse_index():
+    index = MonitorIndex(10)
+    index.add("c1", "a")
+    index.add("c2", "a")
+    index.remove("c1", "A")
+    assert index.watchers_of("a") == {"c2"}
+    assert "c1" not in index.watching
+
+    index.remove("c2", "a")
+    index.remove("c2", "never-added")
+    assert index.watchers == {}
+    assert index.watching == {}
+
+
+def test_clear_drops_all_of_a_clients_watches():
+    index = MonitorIndex(10)
+    for nick in ["a", "b", "c"]:
+        index.add("c1", nick)
+    index.add("c2", "b")
+    index.clear("c1")
+    index.clear("unknown")
+    assert index.targets("c1") == []
+    assert index.watchers == {"b": {"c2"}}
@@ -0,0 +1,119 @@
+import pytest
+
+import utils.overload as overload
+from utils.overload import LoadMonitor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(overload.time, "monotonic", clock.monotonic)
+    monkeypatch.setattr(overload.logger, "log_msg", lambda msg: None)
+    return clock
+
+
+def iteration(monitor, clock, duration):
+    monitor.start()
+    monitor.served()
+    clock.now += duration
+    monitor.finish()
+
+
+def test_cheap_iterations_stay_normal(clock):
+    monitor = LoadMonitor()
+    for _ in range(100):
+        iteration(monitor, clock, 0.001)
+    assert monitor.stage == 0
+    assert monitor.lag == pytest.approx(0.001)
+
+
+def test_single_stall_counts_for_the_whole_window(clock):
+    monitor = LoadMonitor()
+    iteration(monitor, clock, 2)
+    assert monitor.stage == 3
+
+    for _ in range(1000):
+        iteration(monitor, clock, 0.001)
+    assert monitor.lag == pytest.approx(2)
+    assert monitor.stage == 3
+
+
+def test_sockets_served_late_wait_for_the_previous_iteration(clock):
+    monitor = LoadMonitor()
+    iteration(monitor, clock, 0.1)
+
+    # The socket served at the start of this iteration waited for all of the previous one
+    monitor.start()
+    monitor.served()
+    monitor.finish()
+    assert monitor.wait == pytest.approx(0.1)
+
+
+def test_stage_steps_down_once_per_window(clock):
+    monitor = LoadMonitor()
+    iteration(monitor, clock, 2)
+    stages = []
+    for _ in range(40):
+        # An idle second in select between cheap iterations
+        clock.now += 1
+        iteration(monitor, clock, 0.001)
+        stages.append(monitor.stage)
+
+    # Each step down needs a full window of low lag after the last change
+    assert stages[-1] == 0
+    drops = [i for i in range(1, len(stages)) if stages[i] < stages[i - 1]]
+    assert len(drops) == 3
+    assert all(b - a >= 5 for a, b in zip(drops, drops[1:]))
+
+
+def test_stage_holds_while_commands_are_refused(clock):
+    monitor = LoadMonitor()
+    iteration(monitor, clock, 0.1)
+    assert monitor.stage == 1
+
+    # Deferring keeps the iterations short, but the WHO arriving past the budget shows the load is still there
+    for _ in range(20):
+        clock.now += 1
+        monitor.start()
+        clock.now += monitor.budget * 2
+        assert not monitor.allows("WHO")
+        monitor.finish()
+    assert monitor.lag < monitor.thresholds[0] * monitor.recovery
+    assert monitor.stage == 1
+
+    for _ in range(6):
+        clock.now += 1
+        iteration(monitor, clock, 0.001)
+    assert monitor.stage == 0
+
+
+def test_allows_by_stage(clock):
+    monitor = LoadMonitor()
+    assert monitor.allows("WHO")
+    assert monitor.accept_interval() == 0
+    assert monitor.sendq_factor() == 1
+
+    monitor.stage = 1
+    monitor.start()
+    assert monitor.allows("WHO")
+    clock.now += monitor.budget * 2
+    assert not monitor.allows("LIST")
+    assert monitor.allows("JOIN")
+
+    monitor.stage = 2
+    assert monitor.accept_interval() > 0
+    assert monitor.sendq_factor() < 1
+
+    monitor.stage = 3
+    assert not monitor.allows("JOIN")
+    assert monitor.allows("PRIVMSG")
+    assert monitor.allows("PING")
+    assert monitor.refused == 2
@@ -0,0 +1,175 @@
+import json
+import select
+import socket
+import threading
+import time
+
+import utils.logger as logger
+from server import Server
+from utils.replication import ReplicationPrimary, ReplicationStandby, ReplicationState, encode
+
+
+def build_state():
+    state = ReplicationState()
+    state.apply({"op": "register", "nick": "alice", "username": "al", "realname": "Alice", "host": "::1"})
+    state.apply({"op": "register", "nick": "bob", "username": "bo", "realname": "Bob", "host": "::2"})
+    state.apply({"op": "join", "nick": "alice", "channel": "x"})
+    state.apply({"op": "join", "nick": "bob", "channel": "x"})
+    state.apply({"op": "join", "nick": "bob", "channel": "y"})
+    state.apply({"op": "topic", "channel": "x", "topic": "hello"})
+    return state
+
+
+def test_apply_builds_nicks_and_channels():
+    state = build_state()
+    assert state.nicks["alice"]["channels"] == {"x"}
+    assert state.nicks["bob"]["channels"] == {"x", "y"}
+    assert state.channels["x"] == {"topic": "hello", "users": {"alice", "bob"}}
+
+
+def test_nick_change_renames_memberships():
+    state = build_state()
+    state.apply({"op": "nick", "old": "bob", "new": "robert"})
+    assert "bob" not in state.nicks
+    assert state.nicks["robert"]["username"] == "bo"
+    assert state.channels["x"]["users"] == {"alice", "robert"}
+    assert state.channels["y"]["users"] == {"robert"}
+
+
+def test_part_and_quit_drop_empty_channels():
+    state = build_state()
+    state.apply({"op": "part", "nick": "bob", "channel": "y"})
+    assert "y" not in state.channels
+    assert state.nicks["bob"]["channels"] == {"x"}
+
+    state.apply({"op": "quit", "nick": "alice"})
+    state.apply({"op": "quit", "nick": "bob"})
+    assert state.nicks == {}
+    assert state.channels == {}
+
+
+def test_mutations_of_unknown_nicks_are_ignored():
+    state = build_state()
+    state.apply({"op": "join", "nick": "ghost", "channel": "x"})
+    state.apply({"op": "nick", "old": "ghost", "new": "spirit"})
+    state.apply({"op": "quit", "nick": "ghost"})
+    state.apply({"op": "topic", "channel": "nowhere", "topic": "t"})
+    assert state.dump() == build_state().dump()
+
+
+def test_dump_and_load_round_trip_through_json():
+    state = build_state()
+    copy = ReplicationState()
+    copy.apply(json.loads(encode({"seq": 1, "op": "snapshot", "state": state.dump()})))
+    assert copy.nicks == state.nicks
+    assert copy.channels == state.channels
+
+
+def test_primary_without_standby_only_marks_snapshot_stale():
+    primary = ReplicationPrimary("/unused")
+    primary.record({"op": "register", "nick": "alice", "username": "al", "realname": "A", "host": "::1"})
+    assert primary.log == []
+    assert primary.stale
+    assert primary.state.nicks["alice"]["username"] == "al"
+
+
+def test_primary_compacts_once_log_outgrows_state():
+    primary = ReplicationPrimary("/unused", snapshot_every=3)
+    standby, other = socket.socketpair()
+    primary.standbys[standby] = bytearray()
+
+    for i in range(2):
+        primary.record({"op": "register", "nick": "n" + str(i), "username": "u", "realname": "R", "host": "::1"})
+    assert len(primary.log) == 2
+
+    primary.record({"op": "register", "nick": "n2", "username": "u", "realname": "R", "host": "::1"})
+    assert primary.log == []
+    snapshot = json.loads(primary.snapshot)
+    assert snapshot["seq"] == 3
+    assert sorted(snapshot["state"]["nicks"]) == ["n0", "n1", "n2"]
+
+    # Every mutation was still streamed to the standby
+    lines = bytes(primary.standbys[standby]).splitlines()
+    assert [json.loads(line)["seq"] for line in lines] == [1, 2, 3]
+    standby.close()
+    other.close()
+
+
+def pump(primary, until):
+    """ Drives the primary's sockets the way the server's select loop does until a condition holds """
+
+    deadline = time.time() + 5
+    while not until():
+        assert time.time() < deadline
+        readable, writable, _ = select.select(primary.read_sockets(), primary.write_sockets(), [], 0.1)
+        for sock in readable:
+            primary.handle_readable(sock)
+        for sock in writable:
+            primary.handle_writable(sock)
+
+
+def test_standby_resynchronises_after_being_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(logger, "log_msg", lambda *args: None)
+    primary = ReplicationPrimary(str(tmp_path / "replication.sock"))
+    primary.init_socket()
+    standby = ReplicationStandby(primary.path)
+    result = []
+    follower = threading.Thread(target=lambda: result.append(standby.follow()))
+    follower.start()
+
+    pump(primary, lambda: len(primary.standbys) == 1)
+    primary.record({"op": "register", "nick": "alice", "username": "al", "realname": "A", "host": "::1"})
+    pump(primary, lambda: standby.seq == 1)
+
+    # A primary that drops a lagging standby is still alive, the standby follows it again instead of taking over
+    primary.drop(list(primary.standbys)[0])
+    primary.record({"op": "register", "nick": "bob", "username": "bo", "realname": "B", "host": "::2"})
+    pump(primary, lambda: standby.seq == 2)
+    assert follower.is_alive()
+
+    primary.shutdown()
+    follower.join(5)
+    assert sorted(result[0].nicks) == ["alice", "bob"]
+
+
+class FakeClient:
+    def __init__(self, nickname, username, host):
+        self.nickname = nickname
+        self.username = username
+        self.host = host
+
+
+def test_restored_nicks_are_held_for_their_owner():
+    server = Server("Test", 0, "")
+    server.restore(build_state())
+
+    assert server.nick_held_for_other(FakeClient("", "", "::9"), "ALICE")
+    assert not server.nick_held_for_other(FakeClient("", "", "::1"), "alice")
+    assert server.nick_held_for_other(FakeClient("", "mallory", "::1"), "alice")
+    assert not server.nick_held_for_other(FakeClient("", "anyone", "::9"), "carol")
+
+    assert server.reclaim(FakeClient("alice", "mallory", "::1")) == []
+    assert server.reclaim(FakeClient("Alice", "al", "::1")) == ["x"]
+    assert not server.nick_held_for_other(FakeClient("", "", "::9"), "alice")
+    server.workers.shutdown()
+
+
+def test_new_primary_replicates_the_restored_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(logger, "log_msg", lambda *args: None)
+    server = Server("Test", 0, "")
+    state = build_state()
+    server.restore(state)
+    server.start_replication(str(tmp_path / "replication.sock"), state)
+
+    # A standby attaching to the new primary is sent the held nicks and channels
+    server.replication.compact()
+    snapshot = json.loads(server.replication.snapshot)["state"]
+    assert sorted(snapshot["nicks"]) == ["alice", "bob"]
+    assert snapshot["channels"]["x"]["topic"] == "hello"
+
+    # Reclaiming the nick in a different case replaces the held entry with the one registered
+    server.replicate({"op": "register", "nick": "Alice", "username": "al", "realname": "Alice", "host": "::1"})
+    assert server.reclaim(FakeClient("Alice", "al", "::1")) == ["x"]
+    assert sorted(server.replication.state.nicks) == ["Alice", "bob"]
+    server.replication.shutdown()
+    server.workers.shutdown()
@@ -0,0 +1,132 @@
+import socket
+
+import pytest
+
+import utils.logger as logger
+from server import ClientConnection, Server
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(logger, "log_msg", lambda *args: None)
+    monkeypatch.setattr(logger, "log_incoming", lambda *args: None)
+    monkeypatch.setattr(logger, "log_outgoing", lambda *args: None)
+    server = Server("Test", 0, "motd")
+    server.hostname = "::1"
+    yield server
+    server.workers.shutdown()
+
+
+def connect(server, nick):
+    """ Returns a registered ClientConnection and the socket of its peer """
+
+    listener = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    listener.bind(("::1", 0))
+    listener.listen(1)
+    peer = socket.create_connection(("::1", listener.getsockname()[1]))
+    sock, _ = listener.accept()
+    listener.close()
+    sock.setblocking(0)
+
+    client = ClientConnection(sock, server)
+    server.clients[sock] = client
+    client.handle_incoming(("NICK " + nick + "\r\nUSER " + nick + " 0 * :Test\r\n").encode())
+    client.write_queue.clear()
+    return client, peer
+
+
+def replies(client):
+    """ Returns the numerics or commands of the replies queued for a client """
+    return [command.split(" ")[1] for command in client.write_queue]
+
+
+def test_topic_without_target_needs_more_params(server):
+    client, peer = connect(server, "alice")
+    client.handle_incoming(b"TOPIC  :hi\r\n")
+    assert replies(client) == ["461"]
+    peer.close()
+
+
+def big_channel(server, members):
+    """ Creates a channel of registered members that is answered in slices of one member """
+
+    from server import Channel
+    server.who_slice_size = 1
+    server.channels["big"] = Channel("big")
+    peers = []
+    for nick in members:
+        client, peer = connect(server, nick)
+        server.channels["big"].add_user(nick)
+        peers.append(peer)
+    return peers
+
+
+def drain(client):
+    """ Produces and collects a client's sliced replies the way the select loop does """
+
+    sent = replies(client)
+    client.write_queue.clear()
+    while client.output_due():
+        client.produce()
+        sent.extend(replies(client))
+        client.write_queue.clear()
+    return sent
+
+
+def test_list_pauses_behind_sliced_reply(server):
+    from server import Channel
+    for i in range(3 * server.list_page_size):
+        server.directory.update(Channel("c" + str(i)))
+    peers = big_channel(server, ["bob", "carol"])
+    client, peer = connect(server, "alice")
+
+    # Replies queued behind a WHO that is still being built count as unsent output
+    client.handle_incoming(b"WHO #big\r\nLIST\r\n")
+    assert len(client.pending) == 1 + server.list_page_size
+    assert not client.list_page_due()
+
+    client.produce()
+    assert replies(client) == ["352"]
+    assert not client.list_page_due()
+    while len(client.pending) > 0:
+        client.produce()
+    assert not client.list_page_due()
+    client.sendall()
+    assert client.list_page_due()
+    for sock in peers + [peer]:
+        sock.close()
+
+
+def test_pipelined_who_answered_in_order(server):
+    peers = big_channel(server, ["bob", "carol"])
+    client, peer = connect(server, "alice")
+
+    # Each call produces at most one slice
+    client.handle_incoming(b"WHO #big\r\nWHO #big\r\nPING x\r\n")
+    assert client.write_queue == []
+    client.produce()
+    assert len(client.write_queue) == 1
+    assert drain(client) == ["352", "352", "315", "352", "352", "315", "PONG"]
+    for sock in peers + [peer]:
+        sock.close()
+
+
+def test_sliced_who_skips_members_that_left(server):
+    peers = big_channel(server, ["bob", "carol"])
+    client, peer = connect(server, "alice")
+
+    client.handle_incoming(b"WHO #big\r\n")
+    client.produce()
+    del server.nicks["carol"]
+    del server.nicks["bob"]
+    assert drain(client) == ["352", "315"]
+    for sock in peers + [peer]:
+        sock.close()
+
+
+def test_lines_may_end_in_bare_lf(server):
+    client, peer = connect(server, "alice")
+    client.handle_incoming(b"PING a\nPING b\r\nPI")
+    client.handle_incoming(b"NG c\n")
+    assert [command.split(" ")[-1] for command in client.write_queue] == ["a\r\n", "b\r\n", "c\r\n"]
+    peer.close()
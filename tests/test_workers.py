@@ -0,0 +1,71 @@
+import select
+import threading
+
+from utils.workers import WorkerPool
+
+
+def wait_for_results(pool, count):
+    """ Runs the select loop's side of the pool until count callbacks were expected to finish """
+    for _ in range(count):
+        readable, _, _ = select.select([pool.wake_socket], [], [], 5)
+        assert readable
+        pool.process_results()
+        if len(pool.active) == 0:
+            return
+
+
+def test_result_is_delivered_to_callback():
+    pool = WorkerPool(2, 4, 1)
+    results = []
+    assert pool.submit("a", lambda x: x * 2, (21,), results.append)
+    wait_for_results(pool, 5)
+    assert results == [42]
+    assert pool.jobs == {}
+    assert pool.active == set()
+    pool.shutdown()
+
+
+def test_failed_job_calls_back_with_none():
+    pool = WorkerPool(1, 4, 1)
+    results = []
+    pool.submit("a", lambda: 1 / 0, (), results.append)
+    wait_for_results(pool, 5)
+    assert results == [None]
+    pool.shutdown()
+
+
+def test_limits_are_enforced():
+    pool = WorkerPool(1, 2, 1)
+    release = threading.Event()
+    assert pool.submit("a", release.wait, (), lambda r: None)
+    assert not pool.submit("a", release.wait, (), lambda r: None)
+    assert pool.submit("b", release.wait, (), lambda r: None)
+    assert not pool.submit("c", release.wait, (), lambda r: None)
+    release.set()
+    wait_for_results(pool, 10)
+    assert pool.submit("c", lambda: None, (), lambda r: None)
+    pool.shutdown()
+
+
+def test_cancel_drops_running_and_queued_jobs():
+    pool = WorkerPool(1, 4, 2)
+    release = threading.Event()
+    started = threading.Event()
+    results = []
+
+    def running():
+        started.set()
+        release.wait()
+        return "running"
+
+    pool.submit("a", running, (), results.append)
+    started.wait(5)
+    pool.submit("a", lambda: "queued", (), results.append)
+    pool.cancel("a")
+    release.set()
+    wait_for_results(pool, 10)
+
+    assert results == []
+    assert pool.jobs == {}
+    assert pool.active == set()
+    pool.shutdown()
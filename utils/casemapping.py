@@ -0,0 +1,10 @@
+""" Used to compare nicks under the server's CASEMAPPING=ascii """
+
+import string
+
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def casefold(nick):
+    """ Lowercases the ASCII letters of a nick, leaving every other character as it is """
+    return nick.translate(ASCII_LOWER)
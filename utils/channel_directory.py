@@ -0,0 +1,153 @@
+""" Used to answer LIST from a directory of channels that is kept sorted by member count """
+
+import bisect
+import fnmatch
+import time
+
+
+class ChannelDirectory:
+    """ ChannelDirectory caches the listing details of every channel, ordered from most to fewest members
+
+    The server updates the directory whenever a channel's member count or topic changes, so a LIST never
+    has to walk or sort the channels itself. Listings are read in pages from a cursor, which stays valid
+    while channels are added, removed or change size between pages.
+
+    Attributes:
+        keys: A sorted list of (-member count, name) tuples
+        entries: name -> (member count, topic, creation time, topic time)
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.entries = {}
+
+
+    def update(self, channel):
+        """ Add a channel to the directory or refresh its details
+
+        Args:
+            channel: The Channel object
+        """
+
+        old = self.entries.get(channel.name)
+        users = len(channel.users)
+        if old is None or old[0] != users:
+            if old is not None:
+                self.keys.pop(bisect.bisect_left(self.keys, (-old[0], channel.name)))
+            bisect.insort(self.keys, (-users, channel.name))
+        self.entries[channel.name] = (users, channel.topic, channel.created, channel.topic_time)
+
+
+    def remove(self, name):
+        """ Remove a channel from the directory """
+
+        old = self.entries.pop(name, None)
+        if old is not None:
+            self.keys.pop(bisect.bisect_left(self.keys, (-old[0], name)))
+
+
+    def scan(self, cursor, min_users, max_users, limit):
+        """ Returns the next keys in member count order
+
+        Args:
+            cursor: The last key returned by a previous scan, or None to start at the top
+            min_users: Only include channels with at least this many members
+            max_users: Only include channels with at most this many members, or None for no limit
+            limit: The maximum number of keys to return
+        """
+
+        start = 0
+        if max_users is not None:
+            start = bisect.bisect_left(self.keys, (-max_users,))
+        if cursor is not None:
+            start = max(start, bisect.bisect_right(self.keys, cursor))
+        end = bisect.bisect_left(self.keys, (-min_users + 1,))
+        return self.keys[start:min(end, start + limit)]
+
+
+class ListQuery:
+    """ ListQuery holds the filters of a LIST command and the position of a listing in progress
+
+    Supports explicit channel names and the ELIST extensions C (creation time), M (mask), N (negated mask),
+    T (topic time) and U (member count). Times are given in minutes. Topics can also be matched against a
+    mask with T:<mask>, e.g. T:*python*, which is not part of ELIST.
+
+    Attributes:
+        names: Channel names to list, or None to list every matching channel
+        cursor: The last directory key that was scanned
+    """
+
+    def __init__(self, params):
+        self.names = None
+        self.masks = []
+        self.negated_masks = []
+        self.topic_masks = []
+        self.min_users = 0
+        self.max_users = None
+        self.created_after = None
+        self.created_before = None
+        self.topic_after = None
+        self.topic_before = None
+        self.cursor = None
+
+        now = time.time()
+        for token in params.split(" ")[0].split(","):
+            if token == "":
+                continue
+            try:
+                if token[0] == ">":
+                    self.min_users = max(self.min_users, int(token[1:]) + 1)
+                elif token[0] == "<":
+                    self.max_users = int(token[1:]) - 1
+                elif token[:2] == "C<":
+                    self.created_after = now - int(token[2:]) * 60
+                elif token[:2] == "C>":
+                    self.created_before = now - int(token[2:]) * 60
+                elif token[:2] == "T:":
+                    self.topic_masks.append(token[2:].lower())
+                elif token[:2] == "T<":
+                    self.topic_after = now - int(token[2:]) * 60
+                elif token[:2] == "T>":
+                    self.topic_before = now - int(token[2:]) * 60
+                elif token[0] == "!":
+                    self.negated_masks.append(token[1:].lower())
+                elif "*" in token or "?" in token:
+                    self.masks.append(token.lower())
+                else:
+                    # Explicit channel names are looked up directly
+                    if self.names is None:
+                        self.names = []
+                    self.names.append(token[1:] if token[0] == "#" else token)
+            except ValueError:
+                # Ignore malformed conditions
+                continue
+
+
+    def matches(self, name, entry):
+        """ Returns whether a directory entry passes the filters
+
+        Args:
+            name: The channel name
+            entry: The channel's (member count, topic, creation time, topic time) tuple
+        """
+
+        users, topic, created, topic_time = entry
+        if users < self.min_users or (self.max_users is not None and users > self.max_users):
+            return False
+        if self.created_after is not None and created < self.created_after:
+            return False
+        if self.created_before is not None and created > self.created_before:
+            return False
+        if self.topic_after is not None and topic_time < self.topic_after:
+            return False
+        if self.topic_before is not None and topic_time > self.topic_before:
+            return False
+
+        target = "#" + name.lower()
+        if len(self.masks) > 0 and not any(fnmatch.fnmatchcase(target, mask) for mask in self.masks):
+            return False
+        if any(fnmatch.fnmatchcase(target, mask) for mask in self.negated_masks):
+            return False
+        if len(self.topic_masks) > 0 and not any(fnmatch.fnmatchcase(topic.lower(), mask) for mask in self.topic_masks):
+            return False
+        return True
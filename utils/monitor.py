@@ -0,0 +1,81 @@
+""" Used to keep track of which clients are watching which nicks for MONITOR presence notifications """
+
+from utils.casemapping import casefold
+
+
+class MonitorIndex:
+    """ MonitorIndex maps watched nicks to the clients watching them, and clients to the nicks they watch
+
+    Nicks are stored casefolded, so a nick going online or offline can look up its watchers directly
+    instead of scanning every client's list.
+
+    Attributes:
+        limit: The maximum number of nicks a single client may watch
+        watchers: casefolded nick -> set of clients watching it
+        watching: client -> {casefolded nick: nick as the client gave it}
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.watchers = {}
+        self.watching = {}
+
+
+    def add(self, client, nick):
+        """ Start watching a nick
+
+        Returns:
+            False if the client has reached its limit, otherwise True
+        """
+
+        targets = self.watching.get(client, {})
+        folded = casefold(nick)
+        if folded in targets:
+            return True
+        if len(targets) >= self.limit:
+            return False
+
+        targets[folded] = nick
+        self.watching[client] = targets
+        self.watchers.setdefault(folded, set()).add(client)
+        return True
+
+
+    def remove(self, client, nick):
+        """ Stop watching a nick """
+
+        targets = self.watching.get(client)
+        folded = casefold(nick)
+        if targets is None or folded not in targets:
+            return
+
+        del targets[folded]
+        if len(targets) == 0:
+            del self.watching[client]
+        self.unwatch(client, folded)
+
+
+    def clear(self, client):
+        """ Stop watching all nicks a client watches """
+
+        for folded in self.watching.pop(client, {}):
+            self.unwatch(client, folded)
+
+
+    def unwatch(self, client, folded):
+        """ Remove a client from the watchers of a casefolded nick """
+
+        watchers = self.watchers[folded]
+        watchers.discard(client)
+        if len(watchers) == 0:
+            del self.watchers[folded]
+
+
+    def targets(self, client):
+        """ Returns the nicks a client watches, as the client gave them """
+        return list(self.watching.get(client, {}).values())
+
+
+    def watchers_of(self, nick):
+        """ Returns the clients watching a nick """
+        return self.watchers.get(casefold(nick), set())
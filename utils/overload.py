@@ -0,0 +1,135 @@
+""" Used to detect when the server's select loop falls behind and to decide how much load to shed """
+
+import collections
+import time
+import utils.logger as logger
+
+
+class LoadMonitor:
+    """ LoadMonitor measures how long ready sockets wait for the select loop and derives a shedding stage
+
+    A socket that becomes ready just after select returns has to wait for the rest of that iteration, and
+    then for the next iteration to get to it. The loop reports each socket it serves, and the wait is taken
+    as the previous iteration's processing time plus the time since select returned, the worst case for
+    that socket. Lag is the longest wait seen within the last window seconds, so a single long stall counts
+    for the whole window no matter how many cheap iterations follow it.
+
+    The stage rises as soon as lag crosses a threshold. It falls one step at a time once lag has dropped well
+    below the threshold of the current stage and no command has been refused for a whole window, and at most
+    once per window. Refusing commands is what brings lag down, so lag alone would let the stage fall while
+    the load that raised it is still there.
+
+    Stages:
+        0 normal: Everything is served
+        1 defer: Expensive commands are only served during the first budget seconds of an iteration and paged
+          LIST replies are paused
+        2 throttle: New connections are accepted more slowly and output limits are tightened
+        3 critical: Only control and messaging traffic is served
+
+    Attributes:
+        thresholds: The lag in seconds at which stages 1, 2 and 3 are entered
+        recovery: The fraction of a stage's threshold lag has to drop below to leave the stage
+        window: The number of seconds a wait counts towards lag
+        budget: The number of seconds into an iteration after which expensive commands are refused while deferring
+    """
+
+    STAGE_NAMES = ["normal", "defer", "throttle", "critical"]
+    EXPENSIVE_COMMANDS = {"WHO", "LIST"}
+    CONTROL_COMMANDS = {"PING", "PONG", "QUIT", "NICK", "USER", "PRIVMSG", "PART"}
+
+    def __init__(self, thresholds=(0.05, 0.2, 0.5), recovery=0.5, window=5, budget=0.005):
+        self.thresholds = thresholds
+        self.recovery = recovery
+        self.window = window
+        self.budget = budget
+        self.stage = 0
+        self.lag = 0.0
+        self.processing = 0.0 # processing time of the last iteration
+        self.started = time.monotonic()
+        self.wait = 0.0 # the longest socket wait in the current iteration
+        self.waits = collections.deque() # (time, wait) with decreasing waits, the front is the window's maximum
+        self.changed = time.monotonic()
+        self.refused = 0 # commands refused since the last status report
+        self.last_refused = float("-inf") # the time a command was last refused
+
+
+    def start(self):
+        """ Marks the start of an iteration's processing, called when select returns """
+
+        self.started = time.monotonic()
+        self.wait = 0.0
+
+
+    def served(self):
+        """ Records that the loop is about to serve a ready socket """
+        self.wait = self.processing + time.monotonic() - self.started
+
+
+    def finish(self):
+        """ Marks the end of an iteration's processing and updates lag and stage """
+
+        now = time.monotonic()
+        self.processing = now - self.started
+
+        # A socket that became ready as this iteration started waited for all of its processing
+        wait = max(self.wait, self.processing)
+
+        # Keep a sliding window maximum of the waits
+        while len(self.waits) > 0 and self.waits[-1][1] <= wait:
+            self.waits.pop()
+        self.waits.append((now, wait))
+        while self.waits[0][0] < now - self.window:
+            self.waits.popleft()
+        self.lag = self.waits[0][1]
+
+        stage = self.stage
+        while stage < len(self.thresholds) and self.lag >= self.thresholds[stage]:
+            stage += 1
+        if stage == self.stage and stage > 0 and self.lag < self.thresholds[stage - 1] * self.recovery and now - self.changed >= self.window and now - self.last_refused >= self.window:
+            stage -= 1
+
+        if stage != self.stage:
+            logger.log_msg("Load shedding " + self.STAGE_NAMES[self.stage] + " -> " + self.STAGE_NAMES[stage] + ": " + self.status())
+            self.stage = stage
+            self.changed = now
+
+
+    def allows(self, command):
+        """ Returns whether a command should be served at the current stage """
+
+        if self.stage >= 3 and command not in self.CONTROL_COMMANDS:
+            allowed = False
+        elif self.stage >= 1 and command in self.EXPENSIVE_COMMANDS:
+            # Serve as many as fit in the budget, so the loop stays responsive without refusing all of them
+            allowed = time.monotonic() - self.started < self.budget
+        else:
+            allowed = True
+
+        if not allowed:
+            self.refused += 1
+            self.last_refused = time.monotonic()
+        return allowed
+
+
+    def accept_interval(self):
+        """ Returns the minimum number of seconds between accepting new connections """
+
+        if self.stage >= 3:
+            return 0.5
+        if self.stage >= 2:
+            return 0.1
+        return 0
+
+
+    def sendq_factor(self):
+        """ Returns the fraction of the normal output limit clients are allowed at the current stage """
+
+        if self.stage >= 2:
+            return 0.25
+        return 1
+
+
+    def status(self):
+        """ Returns a short description of the current load for the log """
+
+        return "lag " + str(round(self.lag * 1000, 1)) + "ms over " + str(self.window) + "s, last iteration " + str(round(self.processing * 1000, 1)) + "ms, " + str(self.refused) + " commands refused"
@@ -0,0 +1,331 @@
+""" Used to replicate the server's nick and channel state to a hot-standby process
+
+The primary streams every state mutation as a line of JSON over a local (UNIX domain) socket. A standby
+that connects is first sent a compact snapshot of the state followed by the mutations logged since that
+snapshot. When the primary goes away the standby hands the replicated state to a new Server, which takes
+over the listening port.
+"""
+
+import json
+import os
+import socket
+import time
+import utils.logger as logger
+
+
+class ReplicationState:
+    """ ReplicationState is the replicated view of the server, built by applying mutation entries in order
+
+    Attributes:
+        nicks: nick -> {"username", "realname", "host", "channels"} for every registered client
+        channels: channel name -> {"topic", "users"} for every channel with members
+    """
+
+    def __init__(self):
+        self.nicks = {}
+        self.channels = {}
+
+
+    def apply(self, entry):
+        """ Apply a single mutation entry to the state
+
+        Args:
+            entry: A dictionary with an "op" key and the op's fields
+        """
+
+        match entry["op"]:
+            case "snapshot":
+                self.load(entry["state"])
+            case "register":
+                self.nicks[entry["nick"]] = {
+                    "username": entry["username"],
+                    "realname": entry["realname"],
+                    "host": entry["host"],
+                    "channels": set()
+                }
+            case "nick":
+                user = self.nicks.pop(entry["old"], None)
+                if user is None:
+                    return
+                self.nicks[entry["new"]] = user
+                for channel in user["channels"]:
+                    self.channels[channel]["users"].discard(entry["old"])
+                    self.channels[channel]["users"].add(entry["new"])
+            case "join":
+                if entry["nick"] not in self.nicks:
+                    return
+                self.nicks[entry["nick"]]["channels"].add(entry["channel"])
+                channel = self.channels.setdefault(entry["channel"], {"topic": "", "users": set()})
+                channel["users"].add(entry["nick"])
+            case "part":
+                if entry["nick"] in self.nicks:
+                    self.nicks[entry["nick"]]["channels"].discard(entry["channel"])
+                self.leave_channel(entry["nick"], entry["channel"])
+            case "topic":
+                if entry["channel"] in self.channels:
+                    self.channels[entry["channel"]]["topic"] = entry["topic"]
+            case "quit":
+                user = self.nicks.pop(entry["nick"], None)
+                if user is None:
+                    return
+                for channel in user["channels"]:
+                    self.leave_channel(entry["nick"], channel)
+
+
+    def leave_channel(self, nick, channel_name):
+        """ Remove a nick from a channel, dropping the channel once it is empty """
+
+        channel = self.channels.get(channel_name)
+        if channel is None:
+            return
+        channel["users"].discard(nick)
+        if len(channel["users"]) == 0:
+            del self.channels[channel_name]
+
+
+    def dump(self):
+        """ Returns the state as a JSON-serialisable dictionary """
+
+        return {
+            "nicks": {nick: dict(user, channels=sorted(user["channels"])) for nick, user in self.nicks.items()},
+            "channels": {name: {"topic": channel["topic"], "users": sorted(channel["users"])} for name, channel in self.channels.items()}
+        }
+
+
+    def load(self, state):
+        """ Replace the state with a dictionary produced by dump() """
+
+        self.nicks = {nick: dict(user, channels=set(user["channels"])) for nick, user in state["nicks"].items()}
+        self.channels = {name: {"topic": channel["topic"], "users": set(channel["users"])} for name, channel in state["channels"].items()}
+
+
+def encode(entry):
+    """ Encodes an entry as a line of JSON """
+    return (json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+class ReplicationPrimary:
+    """ ReplicationPrimary records the server's mutations and streams them to connected standbys
+
+    The listening socket and standby sockets are non-blocking and are driven by the server's select loop.
+
+    Attributes:
+        path: The filesystem path of the UNIX domain socket to listen on
+        snapshot_every: The minimum number of logged mutations before the log is compacted into a snapshot
+        max_buffer: The maximum number of unsent bytes per standby before it is dropped
+        state: The ReplicationState to start from, e.g. the state taken over from a failed primary
+    """
+
+    def __init__(self, path, snapshot_every=1000, max_buffer=16 * 1024 * 1024, state=None):
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.max_buffer = max_buffer
+        self.state = state if state is not None else ReplicationState()
+        self.seq = 0
+        self.snapshot = encode({"seq": 0, "op": "snapshot", "state": self.state.dump()})
+        self.log = [] # encoded entries since the last snapshot
+        self.stale = False # whether mutations were recorded without logging them, because no standby was connected
+        self.standbys = {} # socket -> bytearray of unsent data
+        self.socket = None
+
+
+    def init_socket(self):
+        """ Initialises the listening socket for standbys, replacing a stale socket file """
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.setblocking(0)
+        self.socket.bind(self.path)
+        self.socket.listen(1)
+        logger.log_msg("Replicating state on " + self.path + ".")
+
+
+    def record(self, entry):
+        """ Apply a mutation to the replicated state and stream it to all standbys
+
+        Args:
+            entry: A dictionary with an "op" key and the op's fields
+        """
+
+        self.seq += 1
+        entry["seq"] = self.seq
+        self.state.apply(entry)
+
+        # Without standbys there is nobody to stream to, the snapshot is brought up to date when one connects
+        if len(self.standbys) == 0:
+            self.stale = True
+            return
+
+        line = encode(entry)
+        self.log.append(line)
+        for sock in list(self.standbys):
+            self.buffer(sock, line)
+
+        # Only compact once the log has grown as large as the state, so the cost of a dump is spread over as
+        # many mutations as it has entries
+        if len(self.log) >= max(self.snapshot_every, len(self.state.nicks) + len(self.state.channels)):
+            self.compact()
+
+
+    def compact(self):
+        """ Replace the mutation log with a snapshot of the current state """
+
+        self.snapshot = encode({"seq": self.seq, "op": "snapshot", "state": self.state.dump()})
+        self.log = []
+        self.stale = False
+
+
+    def buffer(self, sock, data):
+        """ Queue data for a standby, dropping the standby if it has fallen too far behind """
+
+        pending = self.standbys[sock]
+        pending += data
+        if len(pending) > self.max_buffer:
+            logger.log_msg("Dropping replication standby: it has fallen too far behind.")
+            self.drop(sock)
+
+
+    def drop(self, sock):
+        """ Disconnect a standby """
+
+        del self.standbys[sock]
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+
+    def read_sockets(self):
+        """ Returns the sockets the select loop should watch for reading """
+        return [self.socket] + list(self.standbys)
+
+
+    def write_sockets(self):
+        """ Returns the standby sockets that have data waiting to be sent """
+        return [sock for sock, pending in self.standbys.items() if len(pending) > 0]
+
+
+    def owns(self, sock):
+        """ Returns whether a socket belongs to the replication subsystem """
+        return sock == self.socket or sock in self.standbys
+
+
+    def handle_readable(self, sock):
+        """ Accept a new standby, or notice that an existing standby went away """
+
+        if sock == self.socket:
+            standby_sock, _ = sock.accept()
+            standby_sock.setblocking(0)
+            # Catch the standby up with the latest snapshot and the mutations logged since
+            if self.stale:
+                self.compact()
+            self.standbys[standby_sock] = bytearray(self.snapshot + b"".join(self.log))
+            logger.log_msg("Replication standby connected.")
+            return
+
+        try:
+            data = sock.recv(1024)
+        except OSError:
+            data = b""
+        if not data:
+            logger.log_msg("Replication standby disconnected.")
+            self.drop(sock)
+
+
+    def handle_writable(self, sock):
+        """ Send as much buffered data to a standby as its socket accepts """
+
+        if sock not in self.standbys:
+            return
+
+        pending = self.standbys[sock]
+        try:
+            sent = sock.send(pending)
+            del pending[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            logger.log_msg("Replication standby disconnected.")
+            self.drop(sock)
+
+
+    def shutdown(self):
+        """ Closes all replication sockets and removes the socket file """
+
+        for sock in list(self.standbys):
+            self.drop(sock)
+        self.socket.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ReplicationStandby:
+    """ ReplicationStandby follows a primary and keeps a copy of its state
+
+    Attributes:
+        path: The filesystem path of the primary's UNIX domain socket
+        retry_interval: Seconds to wait between attempts to connect to the primary
+    """
+
+    def __init__(self, path, retry_interval=1):
+        self.path = path
+        self.retry_interval = retry_interval
+        self.state = ReplicationState()
+        self.seq = 0
+
+
+    def follow(self):
+        """ Connect to the primary and apply its mutations until it goes away
+
+        Returns:
+            The replicated state at the time the primary was lost
+        """
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        while True:
+            try:
+                sock.connect(self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(self.retry_interval)
+
+        logger.log_msg("Following primary on " + self.path + ".")
+        while sock is not None:
+            self.receive(sock)
+
+            # The primary also drops standbys that fall too far behind, it has only gone away once it stops accepting
+            # connections. A new connection starts with a snapshot, which replaces the state received so far.
+            sock = self.reconnect()
+            if sock is not None:
+                logger.log_msg("Primary dropped the connection after mutation " + str(self.seq) + ", resynchronising.")
+
+        logger.log_msg("Lost primary after mutation " + str(self.seq) + ": " + str(len(self.state.nicks)) + " nicks, " + str(len(self.state.channels)) + " channels.")
+        return self.state
+
+
+    def receive(self, sock):
+        """ Apply the mutations received on a connection to the primary until it is closed """
+
+        try:
+            for line in sock.makefile("rb"):
+                entry = json.loads(line)
+                self.state.apply(entry)
+                self.seq = entry["seq"]
+        except (ConnectionResetError, json.JSONDecodeError):
+            # A torn final line means the primary died or dropped the standby mid-write, everything before it has been applied
+            pass
+        finally:
+            sock.close()
+
+
+    def reconnect(self):
+        """ Returns a new connection to the primary, or None if it no longer accepts connections """
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            return None
+        return sock
@@ -0,0 +1,118 @@
+""" Used to offload expensive work from the server's select loop onto a pool of worker threads """
+
+import concurrent.futures
+import queue
+import socket
+import utils.logger as logger
+
+
+class WorkerPool:
+    """ WorkerPool runs jobs on background threads and hands their results back to the select loop
+
+    Jobs are owned by a client connection. Results are only delivered to the owner while it is still
+    connected, and all of an owner's jobs are dropped when it disconnects. Callbacks always run on the
+    select loop's thread, so they are free to touch server state and queue commands.
+
+    Attributes:
+        workers: The number of worker threads
+        max_pending: The maximum number of jobs that may be queued or running at once
+        max_pending_per_client: The maximum number of jobs a single client may have queued or running
+    """
+
+    def __init__(self, workers, max_pending, max_pending_per_client):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="worker")
+        self.max_pending = max_pending
+        self.max_pending_per_client = max_pending_per_client
+        self.jobs = {} # owner -> set of futures
+        self.active = set() # futures whose results have not been collected yet
+        self.results = queue.SimpleQueue()
+
+        # The select loop watches wake_socket, workers write a byte to notify_socket whenever a job finishes
+        self.wake_socket, self.notify_socket = socket.socketpair()
+        self.wake_socket.setblocking(0)
+        self.notify_socket.setblocking(0)
+
+
+    def submit(self, owner, func, args, callback):
+        """ Submit a job to the pool
+
+        Args:
+            owner: The client the job is run for
+            func: The function to run on a worker thread
+            args: A tuple of arguments for func
+            callback: Called on the select loop with the result of func, or with None if func raised
+
+        Returns:
+            False if the pool or the owner has too many jobs pending, otherwise True
+        """
+
+        owner_jobs = self.jobs.get(owner, set())
+        if len(self.active) >= self.max_pending or len(owner_jobs) >= self.max_pending_per_client:
+            return False
+
+        future = self.executor.submit(func, *args)
+        owner_jobs.add(future)
+        self.jobs[owner] = owner_jobs
+        self.active.add(future)
+        future.add_done_callback(lambda f: self.on_done(owner, f, callback))
+        return True
+
+
+    def cancel(self, owner):
+        """ Drop all jobs of an owner. Jobs that have not started are cancelled, results of running jobs are discarded """
+
+        for future in self.jobs.pop(owner, set()):
+            future.cancel()
+
+
+    def on_done(self, owner, future, callback):
+        """ Hand a finished job over to the select loop. Runs on the worker thread """
+
+        self.results.put((owner, future, callback))
+        try:
+            self.notify_socket.send(b"\0")
+        except BlockingIOError:
+            # The socket buffer is full, so the select loop is already due to wake up
+            pass
+
+
+    def process_results(self):
+        """ Deliver the results of all finished jobs. Called by the select loop when wake_socket is readable """
+
+        try:
+            while self.wake_socket.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while True:
+            try:
+                owner, future, callback = self.results.get_nowait()
+            except queue.Empty:
+                return
+
+            self.active.discard(future)
+
+            # Skip jobs that were dropped because their owner disconnected
+            owner_jobs = self.jobs.get(owner)
+            if owner_jobs is None or future not in owner_jobs:
+                continue
+            owner_jobs.discard(future)
+            if len(owner_jobs) == 0:
+                del self.jobs[owner]
+
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                logger.log_msg("A background job failed: " + repr(future.exception()))
+                callback(None)
+                continue
+            callback(future.result())
+
+
+    def shutdown(self):
+        """ Stops the worker threads and closes the wake-up sockets """
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.wake_socket.close()
+        self.notify_socket.close()